@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Compares the resident size and pickle size of the columnar react store
+# against the original layout (three defaultdicts of sets of React objects).
+#
+#   python benchmarks/memory.py --reacts 1000000
+
+import argparse
+import gc
+import logging
+import os
+import pickle
+import random
+import sys
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from features.squares import Color, React, Reacts
+
+
+class LegacyReacts:
+
+    def __init__(self, color):
+        self.color = color
+        self.by_message_id = defaultdict(set)
+        self.by_target_id = defaultdict(set)
+        self.by_source_id = defaultdict(set)
+
+    def add(self, react):
+        self.by_message_id[react.message_id].add(react)
+        self.by_target_id[react.target_id].add(react)
+        self.by_source_id[react.source_id].add(react)
+
+
+def synthetic_reacts(num_reacts, num_users, seed):
+    rng = random.Random(seed)
+    # one react every 37s up to now, so week and month windows have reacts in them
+    start = datetime.now().replace(microsecond=0) - timedelta(seconds=num_reacts * 37)
+    base_message_id = 1_000_000_000_000_000_000
+    base_user_id = 100_000_000_000_000_000
+    message_id = base_message_id
+    target_id = base_user_id
+    emitted = 0
+    while emitted < num_reacts:
+        # most messages get a react or two, a few get a pile
+        message_id += rng.randrange(1, 1000)
+        target_id = base_user_id + rng.randrange(num_users)
+        num_sources = min(1 + int(rng.paretovariate(1.5)), num_users - 1, num_reacts - emitted)
+        for source in rng.sample(range(num_users), num_sources):
+            source_id = base_user_id + source
+            if source_id == target_id:
+                continue
+            yield (rng.choice(list(Color)), React(message_id, target_id, source_id, start + timedelta(seconds=emitted * 37)))
+            emitted += 1
+
+
+def measure(make, reacts):
+    gc.collect()
+    tracemalloc.start()
+    store = { color : make(color) for color in Color }
+    for (color, react) in reacts:
+        store[color].add(react)
+    gc.collect()
+    resident, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    pickled = len(pickle.dumps(store, protocol=pickle.HIGHEST_PROTOCOL))
+    return resident, pickled
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reacts", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO) # Reacts.add logs every react
+    print(f"{args.reacts} reacts, {args.users} users")
+    results = {}
+    for (name, make) in (("legacy", LegacyReacts), ("columnar", Reacts)):
+        results[name] = measure(make, synthetic_reacts(args.reacts, args.users, args.seed))
+        resident, pickled = results[name]
+        print(f"{name:>10}: resident {resident / 2**20:8.1f} MiB  pickled {pickled / 2**20:8.1f} MiB")
+    (legacy_resident, legacy_pickled) = results["legacy"]
+    (columnar_resident, columnar_pickled) = results["columnar"]
+    print(f"{'ratio':>10}: resident {legacy_resident / columnar_resident:8.1f}x     pickled {legacy_pickled / columnar_pickled:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+# Drives the Squares cog end to end against an in-process stand-in for the
+# discord client: a synthetic guild of users, messages and reaction streams.
+# Reports p50/p99 latency per handler, throughput, peak RSS and bytes written
+# to disk, and saves the results as JSON so runs can be compared.
+#
+#   python benchmarks/pipeline.py --reacts 1000000 --backend sqlite
+#   python benchmarks/pipeline.py --reacts 1000000 --compare benchmarks/results/<earlier run>.json
+
+import argparse
+import asyncio
+import contextlib
+import dataclasses
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+
+import discord
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import features.squares as squares
+from features.squares import Color, COLOR_TO_SQUARE, ReactUpdates
+from memory import synthetic_reacts
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+class FakeUser:
+
+    def __init__(self, id, bot=False):
+        self.id = id
+        self.name = f"user{id}"
+        self.bot = bot
+        self.avatar = None
+
+
+class FakeReaction:
+
+    def __init__(self, world, emoji, source_ids):
+        self._world = world
+        self.emoji = emoji
+        self.count = len(source_ids)
+        self._source_ids = list(source_ids)
+
+    async def users(self):
+        await self._world.round_trip()
+        for source_id in self._source_ids:
+            yield self._world.user(source_id)
+
+
+class FakePartialMessage:
+
+    def __init__(self, world, id):
+        self._world = world
+        self.id = id
+
+    async def edit(self, embed=None, **kwargs):
+        await self._world.round_trip()
+
+    async def delete(self):
+        await self._world.round_trip()
+
+
+class FakeMessage(FakePartialMessage):
+
+    def __init__(self, world, id, channel, author, reactions):
+        super().__init__(world, id)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = f"message {id}"
+        self.attachments = []
+        self.reactions = reactions
+        self.created_at = datetime.now(timezone.utc)
+
+
+class FakeChannel:
+
+    def __init__(self, world, id, name, guild):
+        self._world = world
+        self.id = id
+        self.name = name
+        self.guild = guild
+
+    async def fetch_message(self, message_id):
+        await self._world.round_trip()
+        return self._world.discord_message(self, message_id)
+
+    async def send(self, embed=None, **kwargs):
+        await self._world.round_trip()
+        return FakePartialMessage(self._world, self._world.next_id())
+
+    def get_partial_message(self, message_id):
+        return FakePartialMessage(self._world, message_id)
+
+
+class FakeGuild:
+
+    def __init__(self, id):
+        self.id = id
+        self.text_channels = []
+        self.members = []
+        self.chunked = True
+
+
+class FakeClient:
+
+    # Just enough of discord.Client for the cog. Every REST call costs one
+    # simulated round trip.
+
+    def __init__(self, world):
+        self._world = world
+        self.user = FakeUser(world.next_id(), bot=True)
+        self.intents = discord.Intents.default()
+        self.guilds = [ world.guild ]
+
+    def get_user(self, user_id):
+        return None # as if nobody is in the member cache, so lookups go through the resolver
+
+    async def fetch_user(self, user_id):
+        await self._world.round_trip()
+        return self._world.user(user_id)
+
+    def get_guild(self, guild_id):
+        return self._world.guild if guild_id == self._world.guild.id else None
+
+    def get_channel(self, channel_id):
+        return None
+
+    async def fetch_channel(self, channel_id):
+        await self._world.round_trip()
+        return self._world.channel
+
+
+class World:
+
+    # The "true" state discord would report. Only messages touched during the
+    # run are held here, the rest are read back out of the preloaded store.
+
+    def __init__(self, latency):
+        self._latency = latency
+        self._id = 1 << 62
+        self.guild = FakeGuild(self.next_id())
+        self.channel = FakeChannel(self, self.next_id(), "general", self.guild)
+        self.squareboard = FakeChannel(self, self.next_id(), squares.SQUAREBOARD_CHANNEL_NAME, self.guild)
+        self.guild.text_channels = [ self.channel, self.squareboard ]
+        self._users = {}
+        self.authors = {} # message id -> author id
+        self.sources = {} # message id -> color -> source ids
+        self.reacts = None # the cog's store, to read untouched messages from
+        self.round_trips = 0
+
+    def next_id(self):
+        self._id += 1
+        return self._id
+
+    def user(self, user_id):
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = FakeUser(user_id)
+        return user
+
+    async def round_trip(self):
+        self.round_trips += 1
+        await asyncio.sleep(self._latency)
+
+    def track(self, message_id):
+        if message_id not in self.sources:
+            self.sources[message_id] = { color : { react.source_id for react in self.reacts.reacts_on_message(color, message_id) } for color in Color }
+            for color in Color:
+                for react in self.reacts.reacts_on_message(color, message_id):
+                    self.authors[message_id] = react.target_id
+        return self.sources[message_id]
+
+    def discord_message(self, channel, message_id):
+        reactions = [
+            FakeReaction(self, COLOR_TO_SQUARE[color], source_ids)
+            for color, source_ids in self.track(message_id).items()
+            if source_ids
+        ]
+        return FakeMessage(self, message_id, channel, self.user(self.authors[message_id]), reactions)
+
+
+class FakeContext:
+
+    def __init__(self, world):
+        self._world = world
+        self.channel = world.channel
+        self.guild = world.guild
+        self.sent = 0
+
+    async def defer(self):
+        pass
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.sent += 1
+        return FakePartialMessage(self._world, self._world.next_id())
+
+
+class Timings:
+
+    def __init__(self):
+        self.seconds = []
+
+    @contextlib.contextmanager
+    def __call__(self):
+        start = time.perf_counter()
+        yield
+        self.seconds.append(time.perf_counter() - start)
+
+    def summary(self, elapsed=None):
+        if not self.seconds:
+            return {}
+        ordered = sorted(self.seconds)
+        elapsed = elapsed if elapsed is not None else sum(ordered)
+        return {
+            "count": len(ordered),
+            "p50_ms": statistics.median(ordered) * 1000,
+            "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            "max_ms": ordered[-1] * 1000,
+            "per_second": len(ordered) / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on linux
+
+def bytes_written():
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                (name, value) = line.split(":")
+                if name == "wchar":
+                    return int(value)
+    except FileNotFoundError:
+        pass
+    return sum(stats.bytes for stats in squares.persistence.stats.values())
+
+
+def preload(reacts, messages, world, num_reacts, num_users, seed):
+    BATCH_SIZE = 10_000
+    updates = ReactUpdates()
+    seen = set()
+    for (color, react) in synthetic_reacts(num_reacts, num_users, seed):
+        updates.add(color, react)
+        if react.message_id not in seen:
+            seen.add(react.message_id)
+            message = squares.Message.from_row(react.message_id, world.channel.id, react.target_id, f"message {react.message_id}", world.guild.id, None)
+            messages[react.message_id] = message
+        if len(updates.adds) >= BATCH_SIZE:
+            reacts.commit(updates)
+            updates = ReactUpdates()
+    if updates:
+        reacts.commit(updates)
+    return sorted(seen)
+
+
+async def react_events(cog, world, message_ids, num_events, num_users, rng, timings):
+    base_user_id = 100_000_000_000_000_000
+    start = time.perf_counter()
+    for _ in range(num_events):
+        # most activity is on a small set of recent messages
+        message_id = message_ids[-1 - min(len(message_ids) - 1, int(rng.paretovariate(1.2)) - 1)]
+        sources = world.track(message_id)
+        color = rng.choice(list(Color))
+        present = [ source_id for source_id in sources[color] ]
+        if present and rng.random() < 0.3:
+            source_id = rng.choice(present)
+            sources[color].discard(source_id)
+            event_type = "REACTION_REMOVE"
+        else:
+            source_id = base_user_id + rng.randrange(num_users)
+            if source_id == world.authors[message_id]:
+                continue
+            sources[color].add(source_id)
+            event_type = "REACTION_ADD"
+        ctx = types.SimpleNamespace(
+            message_id=message_id,
+            channel_id=world.channel.id,
+            guild_id=world.guild.id,
+            user_id=source_id,
+            emoji=types.SimpleNamespace(name=COLOR_TO_SQUARE[color]),
+            event_type=event_type,
+            member=world.user(source_id) if event_type == "REACTION_ADD" else None)
+        with timings():
+            await cog._on_reactions_upd([ ctx ])
+    return time.perf_counter() - start
+
+
+async def run(args):
+    world = World(args.latency / 1000)
+    client = FakeClient(world)
+    rng = random.Random(args.seed)
+    results = { "phases": {}, "handlers": {} }
+
+    def phase(name, seconds, written_before):
+        squares.persistence.flush()
+        results["phases"][name] = { "seconds": seconds, "bytes_written": bytes_written() - written_before, "peak_rss": peak_rss() }
+        print(f"{name:>16}: {seconds:8.2f}s  {results['phases'][name]['bytes_written'] / 2**20:8.1f} MiB written  peak rss {peak_rss() / 2**20:8.1f} MiB")
+
+    written = bytes_written()
+    start = time.perf_counter()
+    data_dir = os.path.join(squares.DATA_DIR, "guilds", str(world.guild.id))
+    os.makedirs(data_dir)
+    storage = squares.open_storage(data_dir)
+    message_ids = preload(storage.reacts, storage.messages, world, args.reacts, args.users, args.seed)
+    phase("preload", time.perf_counter() - start, written)
+    results["phases"]["preload"]["reacts_per_second"] = args.reacts / results["phases"]["preload"]["seconds"]
+    if hasattr(storage.reacts, "_journal"):
+        storage.reacts._journal.close()
+    del storage
+
+    written = bytes_written()
+    start = time.perf_counter()
+    cog = squares.Squares(client)
+    await cog.cog_load()
+    state = await cog._guild(world.guild.id)
+    phase("cold start", time.perf_counter() - start, written)
+    world.reacts = state.reacts
+    await cog.on_ready()
+
+    def handler(name, timings, elapsed=None):
+        results["handlers"][name] = summary = timings.summary(elapsed)
+        if summary:
+            print(f"{name:>16}: p50 {summary['p50_ms']:8.3f}ms  p99 {summary['p99_ms']:8.3f}ms  {summary['per_second']:10.1f}/s  (n={summary['count']})")
+
+    written = bytes_written()
+    timings = Timings()
+    elapsed = await react_events(cog, world, message_ids, args.events, args.users, rng, timings)
+    # the squareboard updates kicked off by the commits run on the publisher's
+    # workers, let them finish so they don't overlap the query timings
+    while not cog._squareboard_publisher.idle():
+        await asyncio.sleep(0.001)
+    phase("reactions", elapsed, written)
+    handler("reaction", timings, elapsed)
+
+    ctx = FakeContext(world)
+    for (name, command, kwargs) in (
+        ("squares", cog.squares, {}),
+        ("squares week", cog.squares, { "period": "week" }),
+        ("topgreen", cog.topgreen, {}),
+        ("topgreen week", cog.topgreen, { "period": "week" }),
+    ):
+        timings = Timings()
+        for _ in range(args.queries):
+            with timings():
+                await command.callback(cog, ctx, **kwargs)
+        handler(name, timings)
+
+    # squareboard refreshes of the most squared messages: first an insert, then an amend
+    [ board ] = state.squareboards.boards
+    board.channel = world.squareboard
+    bucket = squares.TokenBucket(1 << 30, 1.0)
+    candidates = []
+    for message_id in state.reacts.top_messages.ranking(Color.GREEN):
+        candidates.append(message_id)
+        if len(candidates) >= args.queries:
+            break
+    inserts = Timings()
+    amends = Timings()
+    config = board.config
+    board.config = dataclasses.replace(config, threshold=0)
+    for message_id in candidates:
+        if board._entries.get(message_id) is not None:
+            del board._entries[message_id]
+        with inserts():
+            await board.publish(message_id, bucket)
+        entry = board._entries.get(message_id)
+        board._entries[message_id] = squares.SquareboardEntry(entry.squareboard_message_id, { color : 0 for color in Color })
+        with amends():
+            await board.publish(message_id, bucket)
+    board.config = config
+    handler("board insert", inserts)
+    handler("board amend", amends)
+
+    await cog.cog_unload()
+    results["round_trips"] = world.round_trips
+    results["peak_rss"] = peak_rss()
+    results["persistence"] = { os.path.basename(filename) : stats.bytes for filename, stats in squares.persistence.stats.items() }
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print(f"compared with {baseline['revision']} ({baseline['started']}), above 1x is better")
+    for (name, summary) in results["handlers"].items():
+        before = baseline["handlers"].get(name)
+        if not summary or not before:
+            continue
+        print(f"{name:>16}: p50 {before['p50_ms'] / summary['p50_ms']:6.2f}x  p99 {before['p99_ms'] / summary['p99_ms']:6.2f}x  throughput {summary['per_second'] / before['per_second']:6.2f}x")
+    print(f"{'peak rss':>16}: {baseline['peak_rss'] / results['peak_rss']:6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reacts", type=int, default=100_000, help="reacts preloaded into the store (10^3 to 10^7)")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--events", type=int, default=2_000, help="reaction events driven through the cog")
+    parser.add_argument("--queries", type=int, default=50, help="calls of each command")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated REST round trip, in milliseconds")
+    parser.add_argument("--backend", choices=("pickle", "sqlite"), default="pickle")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the data directory")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO) # every react add and remove is logged
+    squares.STORAGE_BACKEND = args.backend
+    squares.REACT_COALESCE_WINDOW = 0.0
+    squares.SQUAREBOARD_RATE_LIMIT = 1 << 30
+    data_dir = tempfile.mkdtemp(prefix="squares-benchmark-")
+    cwd = os.getcwd()
+    os.chdir(data_dir)
+    os.mkdir(squares.DATA_DIR)
+    print(f"{args.reacts} reacts, {args.users} users, {args.events} events, {args.backend} backend, in {data_dir}")
+    started = datetime.now(timezone.utc)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(data_dir)
+    results.update({ "revision": git_revision(), "started": started.isoformat(), "args": vars(args) })
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    filename = os.path.join(RESULTS_DIR, f"{started.strftime('%Y%m%dT%H%M%S')}-{args.backend}-{args.reacts}.json")
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved {filename}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import os
 import discord
 import logging
 import sys
+import time
 from discord.ext import commands
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -15,15 +16,19 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.reactions = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = commands.AutoShardedBot(command_prefix='!', intents=intents)
 
 FEATURES = ["features.squares"]
 
 @bot.event
 async def setup_hook():
+    start = time.perf_counter()
     for feature in FEATURES:
         logging.info(f"load feature({feature})")
+        feature_start = time.perf_counter()
         await bot.load_extension(feature)
+        logging.info(f"loaded feature({feature}) in {(time.perf_counter() - feature_start) * 1000:.1f}ms")
+    logging.info(f"startup took {(time.perf_counter() - start) * 1000:.1f}ms")
 #    cmds = await bot.tree.sync()
 #    logging.info(f"synced {len(cmds)} command(s)")
 
@@ -1,14 +1,25 @@
 import abc
+import array
 import asyncio
+import bisect
+import contextlib
+import functools
+import itertools
 import os
-from collections import defaultdict
-from dataclasses import dataclass
-from datetime import datetime
+from collections import Counter, defaultdict, deque, OrderedDict
+from dataclasses import dataclass, fields
+from datetime import date, datetime
 from enum import Enum
 import logging
 import random
 import pickle
 import math
+import mmap
+import sqlite3
+import time
+import struct
+import threading
+import zlib
 from typing import *
 
 import discord
@@ -30,7 +41,29 @@ DESCRIPTION = GREEN_DESCRIPTION + "\n\n" + YELLOW_DESCRIPTION + "\n\n" + RED_DES
 
 SQUAREBOARD_SCORE_THRESHOLD = 6
 SQUAREBOARD_CHANNEL_NAME = "squareboard"
+SQUAREBOARDS = os.getenv("SQUAREBOARDS", f"{SQUAREBOARD_CHANNEL_NAME}:all:{SQUAREBOARD_SCORE_THRESHOLD}") # see SquareboardConfig.parse_many
+SQUAREBOARD_RATE_LIMIT = 5 # squareboard posts, edits and deletes per channel...
+SQUAREBOARD_RATE_LIMIT_PERIOD = 5.0 # ...per this many seconds
+SQUAREBOARD_RETRY_DELAY = 2.0 # seconds before the first retry of a failed squareboard update, doubling after that
+SQUAREBOARD_MAX_ATTEMPTS = 5
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 24 * 60 * 60.0 # seconds a resolved user is trusted for
+USER_CACHE_NEGATIVE_TTL = 60 * 60.0 # seconds an unknown user stays unknown for
+USER_FETCH_CONCURRENCY = 8
+MESSAGE_FETCH_CONCURRENCY = 5
+EMBED_CACHE_SIZE = 1000
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "5000")) # messages held in memory in front of the on-disk message store
 DATA_DIR = "data"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "pickle") # "pickle" or "sqlite"
+JOURNAL_COMPACT_THRESHOLD = int(os.getenv("JOURNAL_COMPACT_THRESHOLD", "1000")) # journal records between snapshots
+RESYNC_INTERVAL = float(os.getenv("RESYNC_INTERVAL", "3600")) # seconds before a message's reacts are re-read from discord
+REACT_COALESCE_WINDOW = float(os.getenv("REACT_COALESCE_WINDOW", "1.0")) # seconds to gather react events on a message before handling them
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # port to serve prometheus metrics on, 0 turns metrics off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+BACKFILL_CONCURRENCY = 3 # channels scanned at once
+BACKFILL_BATCH_SIZE = 100 # messages scanned per commit and checkpoint
+BACKFILL_RATE_LIMIT = 10 # reaction reads...
+BACKFILL_RATE_LIMIT_PERIOD = 1.0 # ...per this many seconds, shared by all channels
 
 
 class Color(Enum):
@@ -40,6 +73,16 @@ class Color(Enum):
 
 SQUARE_TO_COLOR = { "🟥" : Color.RED, "🟨" : Color.YELLOW, "🟩" : Color.GREEN }
 COLOR_TO_SQUARE = { Color.RED : "🟥", Color.YELLOW : "🟨", Color.GREEN : "🟩" }
+COLOR_TO_WEIGHT = { Color.RED : -2, Color.YELLOW : -1, Color.GREEN : +2 }
+
+
+# Diminishing returns for repeated squares from the same source
+def weighted_squares(num_by_source_id: Iterable[int]) -> int:
+    score = 0.0
+    for num in num_by_source_id:
+        score += math.sqrt(num)
+        # score += num / math.sqrt(len(self.by_source_id[source_id]))
+    return int(score)
 
 
 @dataclass
@@ -49,8 +92,9 @@ class React:
     source_id: int # The person who reacted
     timestamp: datetime # The time of the reaction
 
+    @property
     def _id(self):
-        return (self.message_id, self_target_id, self.source_id)
+        return (self.message_id, self.target_id, self.source_id)
 
     def __hash__(self):
         return hash(self._id)
@@ -59,49 +103,230 @@ class React:
         return self._id == other._id
 
 
-@dataclass
 class Reacts:
-    color: Color # For logging
-    by_message_id: defaultdict[int, set[React]]
-    by_target_id: defaultdict[int, set[React]]
-    by_source_id: defaultdict[int, set[React]]
 
-    def __init__(self, color):
-        self.color = color
-        self.by_message_id = defaultdict(set)
-        self.by_target_id = defaultdict(set)
-        self.by_source_id = defaultdict(set)
+    # The reacts of one color, stored column-wise: one row per react in typed
+    # arrays, with user ids interned to small ints and times as epoch seconds.
+    # The access path by message maps a message id to an array of row numbers,
+    # and is only built the first time it is needed, so loading a snapshot is
+    # little more than copying the columns in. Rows freed by removes are reused
+    # by later adds.
 
-    def add(self, react):
+    def __init__(self, color):
+        self.color = color # For logging
+        self._user_ids = array.array('Q') # interned user -> user id
+        self._user_index = {} # user id -> interned user
+        self._message_ids = array.array('Q')
+        self._target_ids = array.array('I') # interned
+        self._source_ids = array.array('I') # interned
+        self._timestamps = array.array('d') # NaN if unknown
+        self._added_at = array.array('d') # when the react was committed, NaN if from before this was kept
+        self._free_rows = []
+        self._rows_by_message_id = {}
+
+    @staticmethod
+    def from_columns(color, user_ids, message_ids, target_ids, source_ids, timestamps, added_at) -> "Reacts":
+        reacts = Reacts(color)
+        reacts._user_ids = user_ids
+        reacts._user_index = { user_id : user for user, user_id in enumerate(user_ids) }
+        reacts._message_ids = message_ids
+        reacts._target_ids = target_ids
+        reacts._source_ids = source_ids
+        reacts._timestamps = timestamps
+        reacts._added_at = added_at
+        reacts._rows_by_message_id = None
+        return reacts
+
+    # Compacted copies of (user_ids, message_ids, target_ids, source_ids, timestamps, added_at)
+    def columns(self) -> Tuple[array.array, ...]:
+        if not self._free_rows:
+            return (self._user_ids, self._message_ids, self._target_ids, self._source_ids, self._timestamps, self._added_at)
+        return (self._user_ids, *(array.array(column.typecode, self._live(column)) for column in (self._message_ids, self._target_ids, self._source_ids, self._timestamps, self._added_at)))
+
+    def add(self, react, added_at=math.nan) -> bool:
         logger.info(f"add {self.color} react by {react.source_id} to {react.target_id} on message({react.message_id})")
-        self.by_message_id[react.message_id].add(react)
-        self.by_target_id[react.target_id].add(react)
-        self.by_source_id[react.source_id].add(react)
+        return self._insert(react, added_at)
 
-    def remove(self, react):
+    def remove(self, react) -> bool:
         logger.info(f"remove {self.color} react by {react.source_id} to {react.target_id} on message({react.message_id})")
-        self.by_message_id[react.message_id].discard(react)
-        self.by_target_id[react.target_id].discard(react)
-        self.by_source_id[react.source_id].discard(react)
-
-    def calculate_weighted_squares_on_user(self, target_id) -> int:
-        num_by_source_id = defaultdict(int)
-        for react in self.by_target_id[target_id]:
-            num_by_source_id[react.source_id] += 1
-        score = 0.0
-        for source_id, num in num_by_source_id.items():
-            score += math.sqrt(num)
-            # score += num / math.sqrt(len(self.by_source_id[source_id]))
-        return int(score)
-
-    def calculate_tally_on_user(self, user_id, source_id=None):
-        reacts = self.by_target_id.get(user_id, [])
-        if source_id is not None:
-            reacts = [ react for react in reacts if react.source_id == source_id ]
-        return len(reacts)
+        return self._discard(react)
+
+    def _intern(self, user_id):
+        user = self._user_index.get(user_id)
+        if user is None:
+            user = len(self._user_ids)
+            self._user_ids.append(user_id)
+            self._user_index[user_id] = user
+        return user
+
+    # The values of a column for rows that hold a react
+    def _live(self, column) -> Iterable:
+        if not self._free_rows:
+            return column
+        free_rows = set(self._free_rows)
+        return (value for row, value in enumerate(column) if row not in free_rows)
+
+    def _build_index(self, column):
+        index = {}
+        free_rows = set(self._free_rows)
+        for row, key in enumerate(column):
+            if row in free_rows:
+                continue
+            rows = index.get(key)
+            if rows is None:
+                index[key] = array.array('I', (row,))
+            else:
+                rows.append(row)
+        return index
+
+    def _by_message_id(self):
+        if self._rows_by_message_id is None:
+            self._rows_by_message_id = self._build_index(self._message_ids)
+        return self._rows_by_message_id
+
+    # The indexes that have been built, with the key of a row in each
+    def _built_indexes(self, row):
+        if self._rows_by_message_id is not None:
+            yield self._rows_by_message_id, self._message_ids[row]
+
+    def _find_row(self, react) -> Optional[int]:
+        target = self._user_index.get(react.target_id)
+        source = self._user_index.get(react.source_id)
+        if target is None or source is None:
+            return None
+        for row in self._by_message_id().get(react.message_id, ()):
+            if self._target_ids[row] == target and self._source_ids[row] == source:
+                return row
+        return None
+
+    # Whether the react was added, it may already be there
+    def _insert(self, react, added_at=math.nan) -> bool:
+        if self._find_row(react) is not None:
+            return False
+        target = self._intern(react.target_id)
+        source = self._intern(react.source_id)
+        timestamp = react.timestamp.timestamp() if react.timestamp is not None else math.nan
+        if self._free_rows:
+            row = self._free_rows.pop()
+            self._message_ids[row] = react.message_id
+            self._target_ids[row] = target
+            self._source_ids[row] = source
+            self._timestamps[row] = timestamp
+            self._added_at[row] = added_at
+        else:
+            row = len(self._message_ids)
+            self._message_ids.append(react.message_id)
+            self._target_ids.append(target)
+            self._source_ids.append(source)
+            self._timestamps.append(timestamp)
+            self._added_at.append(added_at)
+        for (index, key) in self._built_indexes(row):
+            rows = index.get(key)
+            if rows is None:
+                index[key] = array.array('I', (row,))
+            else:
+                rows.append(row)
+        return True
+
+    # Whether the react was removed, it may already be gone
+    def _discard(self, react) -> bool:
+        row = self._find_row(react)
+        if row is None:
+            return False
+        for (index, key) in self._built_indexes(row):
+            rows = index[key]
+            rows.remove(row)
+            if not rows:
+                del index[key]
+        self._free_rows.append(row)
+        return True
+
+    def _react(self, row) -> React:
+        timestamp = self._timestamps[row]
+        return React(
+            self._message_ids[row],
+            self._user_ids[self._target_ids[row]],
+            self._user_ids[self._source_ids[row]],
+            datetime.fromtimestamp(timestamp) if not math.isnan(timestamp) else None)
+
+    def __iter__(self) -> Iterator[React]:
+        free_rows = set(self._free_rows)
+        for row in range(len(self._message_ids)):
+            if row not in free_rows:
+                yield self._react(row)
+
+    def reacts_on_message(self, message_id) -> list[React]:
+        return [ self._react(row) for row in self._by_message_id().get(message_id, ()) ]
+
+    def count_on_message(self, message_id) -> int:
+        return len(self._by_message_id().get(message_id, ()))
+
+    def source_ids_on_message(self, message_id) -> set[int]:
+        return { self._user_ids[self._source_ids[row]] for row in self._by_message_id().get(message_id, ()) }
+
+    def message_ids(self) -> Iterable[int]:
+        return self._by_message_id().keys()
+
+    def target_ids(self) -> set[int]:
+        return { self._user_ids[target] for target in set(self._live(self._target_ids)) }
+
+    # (message_id, target_id, count) for every message, straight from the columns
+    def message_counts(self) -> Iterator[Tuple[int, int, int]]:
+        for (message_id, target), num in Counter(zip(self._live(self._message_ids), self._live(self._target_ids))).items():
+            yield (message_id, self._user_ids[target], num)
+
+    # (target_id, source_id, count) for every pair, straight from the columns
+    def pair_counts(self) -> Iterator[Tuple[int, int, int]]:
+        for (target, source), num in Counter(zip(self._live(self._target_ids), self._live(self._source_ids))).items():
+            yield (self._user_ids[target], self._user_ids[source], num)
+
+    # (epoch seconds, message_id, target_id, source_id) for every react with a known timestamp
+    def dated_reacts(self) -> Iterator[Tuple[float, int, int, int]]:
+        for (timestamp, message_id, target, source) in zip(*(self._live(column) for column in (self._timestamps, self._message_ids, self._target_ids, self._source_ids))):
+            if not math.isnan(timestamp):
+                yield (timestamp, message_id, self._user_ids[target], self._user_ids[source])
+
+    def num_messages(self):
+        return len(self._by_message_id())
+
+    def num_targets(self):
+        return len(self.target_ids())
 
     def __len__(self):
-        return sum(len(reacts) for reacts in self.by_target_id.values())
+        return len(self._message_ids) - len(self._free_rows)
+
+    # Pickled as compacted columns
+    def __getstate__(self):
+        (user_ids, message_ids, target_ids, source_ids, timestamps, added_at) = self.columns()
+        return {
+            "color" : self.color,
+            "user_ids" : user_ids.tobytes(),
+            "message_ids" : message_ids.tobytes(),
+            "target_ids" : target_ids.tobytes(),
+            "source_ids" : source_ids.tobytes(),
+            "timestamps" : timestamps.tobytes(),
+            "added_at" : added_at.tobytes(),
+        }
+
+    def __setstate__(self, state):
+        if "by_message_id" in state:
+            # legacy format: sets of React objects
+            self.__init__(state["color"])
+            for reacts in state["by_message_id"].values():
+                for react in reacts:
+                    self._insert(react)
+            return
+        columns = []
+        for (name, typecode) in (("user_ids", 'Q'), ("message_ids", 'Q'), ("target_ids", 'I'), ("source_ids", 'I'), ("timestamps", 'd')):
+            column = array.array(typecode)
+            column.frombytes(state[name])
+            columns.append(column)
+        added_at = array.array('d')
+        if "added_at" in state:
+            added_at.frombytes(state["added_at"])
+        else:
+            added_at.extend(itertools.repeat(math.nan, len(columns[1])))
+        self.__dict__.update(Reacts.from_columns(state["color"], *columns, added_at).__dict__)
 
 
 class ReactUpdates:
@@ -119,62 +344,898 @@ class ReactUpdates:
         self.removes.append((color, react))
         self.user_pairs.add((react.source_id, react.target_id))
 
+    def extend(self, other):
+        self.adds.extend(other.adds)
+        self.removes.extend(other.removes)
+        self.user_pairs.update(other.user_pairs)
+
     def __bool__(self):
         return bool(self.adds) or bool(self.removes)
 
 
-class ReactsDB:
+class Histogram:
+
+    # Cumulative buckets in the prometheus style, in seconds
+
+    BOUNDS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
     def __init__(self):
-        self._filename = os.path.join(DATA_DIR, "reacts.data")
-        self._load()
+        self.counts = [0] * (len(Histogram.BOUNDS) + 1) # the last is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(Histogram.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # Estimated by interpolating within the bucket the quantile falls in
+    def quantile(self, q) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, num in enumerate(self.counts):
+            if seen + num >= rank and num > 0:
+                lower = Histogram.BOUNDS[i - 1] if i > 0 else 0.0
+                upper = Histogram.BOUNDS[i] if i < len(Histogram.BOUNDS) else Histogram.BOUNDS[-1]
+                return lower + (upper - lower) * (rank - seen) / num
+            seen += num
+        return Histogram.BOUNDS[-1]
+
+
+class Metrics:
+
+    # Histograms and counters keyed by name and labels, rendered in the
+    # prometheus text format. When disabled, timers are a shared no-op and
+    # nothing is recorded. Stats kept elsewhere are pulled in at render time
+    # through registered collectors.
+
+    NO_TIMER = contextlib.nullcontext()
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._lock = threading.Lock() # also observed from the persistence thread
+        self._histograms = defaultdict(Histogram) # (name, labels) -> Histogram
+        self._counters = Counter() # (name, labels) -> count
+        self._collectors = []
+
+    def time(self, name, **labels):
+        if not self.enabled:
+            return Metrics.NO_TIMER
+        return self._time(name, tuple(sorted(labels.items())))
+
+    @contextlib.contextmanager
+    def _time(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._histograms[(name, labels)].observe(seconds)
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._histograms[(name, tuple(sorted(labels.items())))].observe(seconds)
+
+    def count(self, name, num=1, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += num
+
+    # collect() yields (name, type, labels, value), type being "counter" or "gauge"
+    def register(self, collect: Callable[[], Iterable[Tuple[str, str, Dict[str, Any], float]]]):
+        self._collectors.append(collect)
+
+    def unregister(self, collect):
+        if collect in self._collectors:
+            self._collectors.remove(collect)
+
+    # (name, labels, count, p50, p99) of each histogram
+    def histograms(self) -> list[Tuple[str, Tuple, int, float, float]]:
+        with self._lock:
+            return [ (name, labels, histogram.count, histogram.quantile(0.5), histogram.quantile(0.99)) for (name, labels), histogram in sorted(self._histograms.items()) ]
+
+    def counters(self) -> list[Tuple[str, Tuple, int]]:
+        with self._lock:
+            return [ (name, labels, num) for (name, labels), num in sorted(self._counters.items()) ]
+
+    def render(self) -> str:
+        def format_labels(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                declare(name, "histogram")
+                cumulative = 0
+                for bound, num in zip((*Histogram.BOUNDS, "+Inf"), histogram.counts):
+                    cumulative += num
+                    lines.append(f"{name}_bucket{format_labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+            for (name, labels), num in sorted(self._counters.items()):
+                declare(name, "counter")
+                lines.append(f"{name}{format_labels(labels)} {num}")
+        for collect in self._collectors:
+            for (name, kind, labels, value) in collect():
+                declare(name, kind)
+                lines.append(f"{name}{format_labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(METRICS_PORT != 0)
+
+
+@dataclass
+class SaveStats:
+    saves: int = 0
+    coalesced: int = 0 # saves superseded by a newer snapshot before they were written
+    seconds: float = 0.0 # total time spent writing
+    last_seconds: float = 0.0
+    last_bytes: int = 0
+    bytes: int = 0 # total written
+
+
+def _atomic_pickle_dump(filename, obj) -> int:
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    os.replace(tmp_filename, filename)
+    return size
+
+
+class PersistenceWorker:
+
+    # Does all file writes on one background thread, in submission order, so
+    # the event loop never waits on disk. Whole-file saves are given an
+    # immutable snapshot; if a newer snapshot of the same file arrives before
+    # the old one is written, only the newer one is written.
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._tasks = deque() # callables, or filenames with a pending snapshot
+        self._snapshots = {} # filename -> latest snapshot to write
+        self._busy = False
+        self._thread = None
+        self.stats = defaultdict(SaveStats) # filename -> SaveStats
+
+    def submit(self, task: Callable[[], Any]):
+        with self._condition:
+            self._tasks.append(task)
+            self._wake()
+
+    def save(self, filename, snapshot):
+        with self._condition:
+            if filename in self._snapshots:
+                self.stats[filename].coalesced += 1
+            else:
+                self._tasks.append(filename)
+            self._snapshots[filename] = snapshot
+            self._wake()
+
+    # Block until everything submitted so far is on disk
+    def flush(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._tasks and not self._busy)
+
+    def _wake(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+            self._thread.start()
+        self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._tasks)
+                task = self._tasks.popleft()
+                if isinstance(task, str):
+                    snapshot = self._snapshots.pop(task)
+                self._busy = True
+            try:
+                if isinstance(task, str):
+                    self._save(task, snapshot)
+                else:
+                    task()
+            except Exception:
+                logger.exception("persistence task failed")
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _save(self, filename, snapshot):
+        start = time.perf_counter()
+        size = _atomic_pickle_dump(filename, snapshot)
+        seconds = time.perf_counter() - start
+        self.record(filename, seconds, size)
+        logger.info("saved %s in %.1fms (%d bytes)", filename, seconds * 1000, size)
+
+    # Count a write of size bytes to the file, whether a save or an append
+    def record(self, filename, seconds, size):
+        stats = self.stats[filename]
+        stats.saves += 1
+        stats.seconds += seconds
+        stats.last_seconds = seconds
+        stats.last_bytes = size
+        stats.bytes += size
+        metrics.observe("squares_stage_seconds", seconds, stage="persist", file=os.path.relpath(filename, DATA_DIR))
+
+
+persistence = PersistenceWorker()
+
+
+class Journal:
+
+    # Each record is framed as (length, crc32) followed by the pickled payload.
+    # A torn or corrupt record can only be the result of a crash mid-append, so
+    # reading stops there and everything before it is kept.
+    HEADER = struct.Struct("<II")
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._file = None
+        self.num_records = 0
+
+    @staticmethod
+    def read(filename) -> Iterator[Any]:
+        for (_, payload) in Journal._scan(filename):
+            yield pickle.loads(payload)
+
+    # Yields (end offset, payload) for each intact record
+    @staticmethod
+    def _scan(filename):
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                header = f.read(Journal.HEADER.size)
+                if len(header) < Journal.HEADER.size:
+                    return
+                length, crc = Journal.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                yield f.tell(), payload
+
+    def open(self):
+        # Count the intact records and chop off any torn tail so that new
+        # records are never appended after garbage
+        valid_length = 0
+        self.num_records = 0
+        for (end, _) in Journal._scan(self._filename):
+            valid_length = end
+            self.num_records += 1
+        self._file = open(self._filename, 'ab')
+        if self._file.tell() != valid_length:
+            logger.warning("truncate journal(%s) from %d to %d bytes", self._filename, self._file.tell(), valid_length)
+            self._file.truncate(valid_length)
+            self._file.seek(valid_length)
+
+    # Once open, the file is only touched from the persistence thread
+    def append(self, record):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        persistence.submit(functools.partial(self._write, Journal.HEADER.pack(len(payload), zlib.crc32(payload)) + payload))
+        self.num_records += 1
+
+    def _write(self, data):
+        start = time.perf_counter()
+        self._file.write(data)
+        self._file.flush()
+        persistence.record(self._filename, time.perf_counter() - start, len(data))
+
+    # Seal the current journal under a new name and start an empty one.
+    # Call from the persistence thread.
+    def rotate(self, sealed_filename):
+        self._file.close()
+        os.replace(self._filename, sealed_filename)
+        self._file = open(self._filename, 'ab')
+
+    def close(self):
+        def close():
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        persistence.submit(close)
+
+
+def _empty_reacts_by_color():
+    return {
+        Color.GREEN  : Reacts(Color.GREEN),
+        Color.YELLOW : Reacts(Color.YELLOW),
+        Color.RED    : Reacts(Color.RED)
+    }
+
+# The snapshot is the raw bytes of each color's columns behind a small header,
+# so loading it is a memory map and a copy per column.
+REACTS_SNAPSHOT_MAGIC = b"SQUARES2"
+REACTS_SNAPSHOT_HEADER = struct.Struct("<8sQ")
+REACTS_SNAPSHOT_COLOR_HEADER = struct.Struct("<QQ") # number of users, number of rows
+REACTS_SNAPSHOT_COLUMNS = ('Q', 'Q', 'I', 'I', 'd', 'd') # user_ids, then message_ids, target_ids, source_ids, timestamps, added_at
+REACTS_SNAPSHOT_V1_MAGIC = b"SQUARES1" # from before added_at, with every column but the last
+
+# The column typecodes of a snapshot with the given magic, or None if it isn't one
+def _reacts_snapshot_columns(magic) -> Optional[Tuple[str, ...]]:
+    if magic == REACTS_SNAPSHOT_MAGIC:
+        return REACTS_SNAPSHOT_COLUMNS
+    if magic == REACTS_SNAPSHOT_V1_MAGIC:
+        return REACTS_SNAPSHOT_COLUMNS[:-1]
+    return None
+
+def _load_reacts_snapshot(filename):
+    try:
+        f = open(filename, 'rb')
+    except FileNotFoundError:
+        return 0, _empty_reacts_by_color()
+    with f:
+        typecodes = _reacts_snapshot_columns(f.read(len(REACTS_SNAPSHOT_MAGIC)))
+        if typecodes is None:
+            f.seek(0)
+            snapshot = pickle.load(f)
+            if isinstance(snapshot, dict):
+                return 0, snapshot # legacy format, from before the journal
+            return snapshot # legacy format, from before memory mapping
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            (_, seq) = REACTS_SNAPSHOT_HEADER.unpack_from(mm, 0)
+            offset = REACTS_SNAPSHOT_HEADER.size
+            sizes = []
+            for color in Color:
+                sizes.append(REACTS_SNAPSHOT_COLOR_HEADER.unpack_from(mm, offset))
+                offset += REACTS_SNAPSHOT_COLOR_HEADER.size
+            reacts_by_color = {}
+            with memoryview(mm) as view:
+                for color, (num_users, num_rows) in zip(Color, sizes):
+                    columns = []
+                    for i, typecode in enumerate(typecodes):
+                        column = array.array(typecode)
+                        length = (num_users if i == 0 else num_rows) * column.itemsize
+                        column.frombytes(view[offset:offset + length])
+                        offset += length
+                        columns.append(column)
+                    if len(columns) < len(REACTS_SNAPSHOT_COLUMNS):
+                        columns.append(array.array('d', itertools.repeat(math.nan, num_rows)))
+                    reacts_by_color[color] = Reacts.from_columns(color, *columns)
+    return seq, reacts_by_color
+
+def _save_reacts_snapshot(filename, seq, reacts_by_color):
+    columns_by_color = { color : reacts_by_color[color].columns() for color in Color }
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'wb') as f:
+        f.write(REACTS_SNAPSHOT_HEADER.pack(REACTS_SNAPSHOT_MAGIC, seq))
+        for color in Color:
+            (user_ids, message_ids, *_) = columns_by_color[color]
+            f.write(REACTS_SNAPSHOT_COLOR_HEADER.pack(len(user_ids), len(message_ids)))
+        for color in Color:
+            for column in columns_by_color[color]:
+                column.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+# Journal records are (seq, adds, removes, added_at), without added_at if
+# written before it was kept
+def _journal_record_added_at(record) -> float:
+    return record[3] if len(record) > 3 else math.nan
+
+# Apply journal records with seq > after_seq, returning the last seq applied.
+# Pair counts, if given, are kept in step with the reacts.
+def _replay_reacts_journal(filename, reacts_by_color, after_seq, pair_counts: Optional[Counter] = None):
+    seq = after_seq
+    for record in Journal.read(filename):
+        (record_seq, adds, removes) = record[:3]
+        if record_seq <= seq:
+            continue
+        added_at = _journal_record_added_at(record)
+        for (color, message_id, target_id, source_id, timestamp) in adds:
+            if reacts_by_color[Color(color)]._insert(React(message_id, target_id, source_id, timestamp), added_at) and pair_counts is not None:
+                pair_counts[(Color(color), target_id, source_id)] += 1
+        for (color, message_id, target_id, source_id, timestamp) in removes:
+            if reacts_by_color[Color(color)]._discard(React(message_id, target_id, source_id, timestamp)) and pair_counts is not None:
+                pair_counts[(Color(color), target_id, source_id)] -= 1
+        seq = record_seq
+    return seq
+
+# The pair counts of a snapshot, saved next to it so that startup doesn't have
+# to recount them from every react. Only trusted if saved at the same seq.
+REACTS_PAIRS_MAGIC = b"SQPAIRS1"
+REACTS_PAIRS_HEADER = struct.Struct("<8sQQ") # magic, seq, number of pairs
+REACTS_PAIRS_COLUMNS = ('B', 'Q', 'Q', 'I') # colors, target_ids, source_ids, counts
+
+def _load_pair_counts(filename, seq) -> Optional[Counter]:
+    try:
+        f = open(filename, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        header = f.read(REACTS_PAIRS_HEADER.size)
+        if len(header) < REACTS_PAIRS_HEADER.size:
+            return None
+        (magic, pairs_seq, num_pairs) = REACTS_PAIRS_HEADER.unpack(header)
+        if magic != REACTS_PAIRS_MAGIC or pairs_seq != seq:
+            return None
+        columns = []
+        for typecode in REACTS_PAIRS_COLUMNS:
+            column = array.array(typecode)
+            column.fromfile(f, num_pairs)
+            columns.append(column)
+    (colors, target_ids, source_ids, counts) = columns
+    return Counter({ (Color(color), target_id, source_id) : num for (color, target_id, source_id, num) in zip(colors, target_ids, source_ids, counts) })
+
+def _save_pair_counts(filename, seq, reacts_by_color):
+    columns = tuple(array.array(typecode) for typecode in REACTS_PAIRS_COLUMNS)
+    (colors, target_ids, source_ids, counts) = columns
+    for color in Color:
+        for (target_id, source_id, num) in reacts_by_color[color].pair_counts():
+            colors.append(color.value)
+            target_ids.append(target_id)
+            source_ids.append(source_id)
+            counts.append(num)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'wb') as f:
+        f.write(REACTS_PAIRS_HEADER.pack(REACTS_PAIRS_MAGIC, seq, len(counts)))
+        for column in columns:
+            column.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+class PairCounts:
+
+    # A sparse matrix per color of how many reacts each source has given each
+    # target, indexed both ways so that who squared a user, and whom a user
+    # squared, are each O(degree) to read.
+
+    def __init__(self, pair_counts: Iterable[Tuple[Color, int, int, int]]):
+        self._by_target = { color : {} for color in Color } # target -> source -> count
+        self._by_source = { color : {} for color in Color } # source -> target -> count
+        for (color, target_id, source_id, num) in pair_counts:
+            self._add(color, target_id, source_id, num)
+
+    def update(self, react_updates: ReactUpdates):
+        for (color, react) in react_updates.adds:
+            self._add(color, react.target_id, react.source_id, +1)
+        for (color, react) in react_updates.removes:
+            self._add(color, react.target_id, react.source_id, -1)
+
+    def _add(self, color, target_id, source_id, delta):
+        for (index, key, other) in ((self._by_target[color], target_id, source_id), (self._by_source[color], source_id, target_id)):
+            counts = index.get(key)
+            if counts is None:
+                counts = index[key] = {}
+            num = counts.get(other, 0) + delta
+            if num > 0:
+                counts[other] = num
+            else:
+                counts.pop(other, None)
+                if not counts:
+                    del index[key]
+
+    # source id -> number of reacts of the color on the target
+    def sources(self, color, target_id) -> Dict[int, int]:
+        return self._by_target[color].get(target_id, {})
+
+    # target id -> number of reacts of the color by the source
+    def targets(self, color, source_id) -> Dict[int, int]:
+        return self._by_source[color].get(source_id, {})
+
+    def target_ids(self) -> set[int]:
+        return set().union(*(self._by_target[color].keys() for color in Color))
+
+    # (color, target_id, source_id, count) for every pair
+    def __iter__(self) -> Iterator[Tuple[Color, int, int, int]]:
+        for color in Color:
+            for (target_id, num_by_source_id) in self._by_target[color].items():
+                for (source_id, num) in num_by_source_id.items():
+                    yield (color, target_id, source_id, num)
+
+
+class Leaderboard:
+
+    # Maintains each target's weighted score from the pair counts, with targets
+    # kept sorted by decreasing score. A commit only rescores the targets of
+    # the pairs it touched.
+
+    def __init__(self, pair_counts: Iterable[Tuple[Color, int, int, int]]):
+        self.pairs = PairCounts(pair_counts)
+        self._scores = {}
+        self._ranking = [] # sorted list of (-score, target_id)
+        for target_id in self.pairs.target_ids():
+            self._rescore(target_id)
+
+    def update(self, react_updates: ReactUpdates):
+        self.pairs.update(react_updates)
+        for target_id in { target_id for (_, target_id) in react_updates.user_pairs }:
+            self._rescore(target_id)
+
+    def _rescore(self, target_id):
+        old_score = self._scores.pop(target_id, None)
+        if old_score is not None:
+            del self._ranking[bisect.bisect_left(self._ranking, (-old_score, target_id))]
+        num_by_source_id_by_color = { color : self.pairs.sources(color, target_id) for color in Color }
+        if not any(num_by_source_id_by_color.values()):
+            return
+        score = sum(
+            COLOR_TO_WEIGHT[color] * weighted_squares(num_by_source_id.values())
+            for color, num_by_source_id in num_by_source_id_by_color.items()
+            if num_by_source_id
+        )
+        self._scores[target_id] = score
+        bisect.insort(self._ranking, (-score, target_id))
+
+    def tally(self, target_id) -> Dict[Color, int]:
+        return { color : sum(self.pairs.sources(color, target_id).values()) for color in Color }
+
+    def score(self, target_id) -> int:
+        return self._scores.get(target_id, 0)
+
+    # A list of (target_id, tally, score), ordered by decreasing score
+    def ranking(self) -> list[Tuple[int, Dict[Color, int], int]]:
+        return [ (target_id, self.tally(target_id), -neg_score) for (neg_score, target_id) in self._ranking ]
+
+
+class MessageRanking:
+
+    # Message ids bucketed by count. Counts are small (at most the number of
+    # people who can react), so walking the buckets from the top yields the
+    # highest counted messages in O(K) regardless of how many messages there are.
+    # Ties go to whichever message reached the count first.
+
+    def __init__(self):
+        self._count_by_message_id = {}
+        self._message_ids_by_count = defaultdict(dict) # count -> { message id : None }, in arrival order
+        self._counts = [] # sorted counts with a non-empty bucket
+
+    def update(self, message_id, delta):
+        old_count = self._count_by_message_id.get(message_id, 0)
+        new_count = old_count + delta
+        if old_count > 0:
+            bucket = self._message_ids_by_count[old_count]
+            del bucket[message_id]
+            if not bucket:
+                del self._message_ids_by_count[old_count]
+                del self._counts[bisect.bisect_left(self._counts, old_count)]
+        if new_count > 0:
+            self._count_by_message_id[message_id] = new_count
+            bucket = self._message_ids_by_count[new_count]
+            if not bucket:
+                bisect.insort(self._counts, new_count)
+            bucket[message_id] = None
+        else:
+            self._count_by_message_id.pop(message_id, None)
+
+    # Message ids by decreasing count. Don't await while iterating.
+    def __iter__(self) -> Iterator[int]:
+        for count in reversed(self._counts):
+            yield from self._message_ids_by_count[count]
+
+    def __len__(self):
+        return len(self._count_by_message_id)
+
+
+class TopMessages:
+
+    # A MessageRanking per color, and per (color, author)
+
+    def __init__(self, message_counts: Iterable[Tuple[Color, int, int, int]]):
+        self._by_color = { color : MessageRanking() for color in Color }
+        self._by_color_and_target_id = defaultdict(MessageRanking)
+        for (color, message_id, target_id, num) in message_counts:
+            self._by_color[color].update(message_id, num)
+            self._by_color_and_target_id[(color, target_id)].update(message_id, num)
+
+    def update(self, react_updates: ReactUpdates):
+        for (color, react) in react_updates.adds:
+            self._update(color, react, +1)
+        for (color, react) in react_updates.removes:
+            self._update(color, react, -1)
+
+    def _update(self, color, react, delta):
+        self._by_color[color].update(react.message_id, delta)
+        key = (color, react.target_id)
+        ranking = self._by_color_and_target_id[key]
+        ranking.update(react.message_id, delta)
+        if not ranking:
+            del self._by_color_and_target_id[key]
+
+    def ranking(self, color, target_id=None) -> MessageRanking:
+        if target_id is None:
+            return self._by_color[color]
+        return self._by_color_and_target_id.get((color, target_id), MessageRanking())
+
+
+def epoch_day(epoch: float) -> int:
+    return int(epoch // (24 * 60 * 60)) + EPOCH_ORDINAL
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class ReactCalendar:
+
+    # React counts bucketed by the (UTC) day the react was made, as date
+    # ordinals: per (color, target, source) for leaderboards and per
+    # (color, message, target) for top messages. A window over a range of days
+    # only has to add up the buckets in it. Reacts without a timestamp only
+    # count towards all-time.
+
+    def __init__(self, dated_reacts: Iterable[Tuple[Color, float, int, int, int]]):
+        self._pair_counts_by_day = defaultdict(Counter) # day -> (color, target_id, source_id) -> count
+        self._message_counts_by_day = defaultdict(Counter) # day -> (color, message_id, target_id) -> count
+        for (color, timestamp, message_id, target_id, source_id) in dated_reacts:
+            day = epoch_day(timestamp)
+            self._pair_counts_by_day[day][(color, target_id, source_id)] += 1
+            self._message_counts_by_day[day][(color, message_id, target_id)] += 1
+        self._days = sorted(self._pair_counts_by_day.keys())
+
+    def update(self, react_updates: ReactUpdates):
+        for (color, react) in react_updates.adds:
+            self._update(color, react, +1)
+        for (color, react) in react_updates.removes:
+            self._update(color, react, -1)
+
+    def _update(self, color, react, delta):
+        if react.timestamp is None:
+            return
+        day = epoch_day(react.timestamp.timestamp())
+        if day not in self._pair_counts_by_day:
+            bisect.insort(self._days, day)
+        pair_counts = self._pair_counts_by_day[day]
+        message_counts = self._message_counts_by_day[day]
+        for (counts, key) in ((pair_counts, (color, react.target_id, react.source_id)), (message_counts, (color, react.message_id, react.target_id))):
+            counts[key] += delta
+            if counts[key] <= 0:
+                del counts[key]
+        if not pair_counts:
+            del self._pair_counts_by_day[day]
+            del self._message_counts_by_day[day]
+            self._days.remove(day)
+
+    # Days with reacts in [start, end)
+    def _days_between(self, start: int, end: int) -> list[int]:
+        return self._days[bisect.bisect_left(self._days, start):bisect.bisect_left(self._days, end)]
+
+    # (color, target_id, source_id, count) for every pair with a react in [start, end)
+    def pair_counts(self, start: int, end: int) -> Iterator[Tuple[Color, int, int, int]]:
+        total = Counter()
+        for day in self._days_between(start, end):
+            total.update(self._pair_counts_by_day[day])
+        for (color, target_id, source_id), num in total.items():
+            yield (color, target_id, source_id, num)
+
+    # Message ids with a react of the color in [start, end), by decreasing count
+    def message_ranking(self, color, start: int, end: int, target_id=None) -> list[int]:
+        total = Counter()
+        for day in self._days_between(start, end):
+            for (message_color, message_id, message_target_id), num in self._message_counts_by_day[day].items():
+                if message_color == color and (target_id is None or message_target_id == target_id):
+                    total[message_id] += num
+        return [ message_id for (message_id, _) in total.most_common() ]
+
+
+@dataclass
+class Window:
+    start: int # first day, as a date ordinal
+    end: int # the day after the last
+    description: str
+
+    PERIODS = { "week" : 7, "month" : 30, "year" : 365 }
+
+    # "week", "month" or "year" (ending today), a date "YYYY-MM-DD" or a range of dates "YYYY-MM-DD..YYYY-MM-DD"
+    @staticmethod
+    def parse(period: str, today: int) -> "Window":
+        period = period.strip().lower()
+        if period in Window.PERIODS:
+            return Window(today + 1 - Window.PERIODS[period], today + 1, f"the past {period}")
+        (first, _, last) = period.partition("..")
+        try:
+            first_day = date.fromisoformat(first)
+            last_day = date.fromisoformat(last) if last else first_day
+        except ValueError:
+            raise commands.BadArgument(f"unknown period({period}), expected week, month, year, YYYY-MM-DD or YYYY-MM-DD..YYYY-MM-DD")
+        if last_day < first_day:
+            raise commands.BadArgument(f"period({period}) ends before it starts")
+        description = first_day.isoformat() if first_day == last_day else f"{first_day.isoformat()} to {last_day.isoformat()}"
+        return Window(first_day.toordinal(), last_day.toordinal() + 1, description)
+
+
+class ReactsStore(metaclass=abc.ABCMeta):
+
+    # Subclasses call this once their state is loaded
+    def _build_aggregates(self):
+        start = time.perf_counter()
+        self.leaderboard = Leaderboard(self._initial_pair_counts())
+        self.top_messages = TopMessages(self.message_counts())
+        self.calendar = ReactCalendar(self.dated_reacts())
+        logger.info("built react aggregates in %.1fms", (time.perf_counter() - start) * 1000)
 
     def commit(self, react_updates: ReactUpdates):
+        with metrics.time("squares_stage_seconds", stage="commit"):
+            applied = self._commit(react_updates)
+            self.leaderboard.update(applied)
+            self.top_messages.update(applied)
+            self.calendar.update(applied)
+
+    # Returns the updates that changed the store: adds of reacts already there
+    # and removes of reacts already gone are skipped, and mustn't be counted
+    @abc.abstractmethod
+    def _commit(self, react_updates: ReactUpdates) -> ReactUpdates:
+        raise NotImplementedError()
+
+    # Where the leaderboard's pair counts come from at startup
+    def _initial_pair_counts(self) -> Iterable[Tuple[Color, int, int, int]]:
+        return self.pair_counts()
+
+    @abc.abstractmethod
+    def calculate_tally_on_message(self, message_id) -> Dict[Color, int]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def source_ids_on_message(self, message_id) -> Dict[Color, Set[int]]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def reacts_on_message(self, color, message_id) -> list[React]:
+        raise NotImplementedError()
+
+    # (color, message_id, target_id, count) for every message with at least one react of that color
+    @abc.abstractmethod
+    def message_counts(self) -> Iterator[Tuple[Color, int, int, int]]:
+        raise NotImplementedError()
+
+    # (color, target_id, source_id, count) for every pair with at least one react
+    @abc.abstractmethod
+    def pair_counts(self) -> Iterator[Tuple[Color, int, int, int]]:
+        raise NotImplementedError()
+
+    # (color, epoch seconds, message_id, target_id, source_id) for every react with a known timestamp
+    @abc.abstractmethod
+    def dated_reacts(self) -> Iterator[Tuple[Color, float, int, int, int]]:
+        raise NotImplementedError()
+
+
+class ReactsDB(ReactsStore):
+
+    # State is a snapshot (reacts.data) plus a journal of the ReactUpdates
+    # committed since (reacts.log). Once the journal grows long enough it is
+    # sealed (reacts.log.old) and folded into a new snapshot in the background,
+    # along with the snapshot's pair counts (reacts.pairs).
+
+    def __init__(self, data_dir=DATA_DIR):
+        self._filename = os.path.join(data_dir, "reacts.data")
+        self._pairs_filename = os.path.join(data_dir, "reacts.pairs")
+        self._journal_filename = os.path.join(data_dir, "reacts.log")
+        self._sealed_journal_filename = os.path.join(data_dir, "reacts.log.old")
+        self._compacting = False
+        self._load()
+        self._build_aggregates()
+
+    def _commit(self, react_updates: ReactUpdates):
+        added_at = time.time()
+        applied = ReactUpdates()
         for (color, react) in react_updates.adds:
-            self._reacts_by_color[color].add(react)
+            if self._reacts_by_color[color].add(react, added_at):
+                applied.add(color, react)
         for (color, react) in react_updates.removes:
-            self._reacts_by_color[color].remove(react)
-        self._save()
+            if self._reacts_by_color[color].remove(react):
+                applied.remove(color, react)
+        self._seq += 1
+        self._journal.append((
+            self._seq,
+            [ (color.value, react.message_id, react.target_id, react.source_id, react.timestamp) for (color, react) in applied.adds ],
+            [ (color.value, react.message_id, react.target_id, react.source_id, react.timestamp) for (color, react) in applied.removes ],
+            added_at,
+        ))
+        if self._journal.num_records >= JOURNAL_COMPACT_THRESHOLD:
+            self._compact()
+        return applied
 
     def calculate_tally_on_message(self, message_id):
-        return { color : len(self._reacts_by_color[color].by_message_id.get(message_id, [])) for color in Color }
+        return { color : self._reacts_by_color[color].count_on_message(message_id) for color in Color }
+
+    def source_ids_on_message(self, message_id):
+        return { color : self._reacts_by_color[color].source_ids_on_message(message_id) for color in Color }
 
-    def calculate_tally_on_user(self, user_id, source_id=None):
-        return { color : self._reacts_by_color[color].calculate_tally_on_user(user_id, source_id) for color in Color }
+    def reacts_on_message(self, color, message_id):
+        return self._reacts_by_color[color].reacts_on_message(message_id)
 
-    def calculate_unique_squarers_on_message(self, message_id):
-        source_ids = { react.source_id for color in Color for react in self._reacts_by_color[color].by_message_id.get(message_id, []) }
-        return len(source_ids)
+    def message_counts(self):
+        for color in Color:
+            for (message_id, target_id, num) in self._reacts_by_color[color].message_counts():
+                yield (color, message_id, target_id, num)
 
-    def calculate_weighted_squares_on_user(self, user_id):
-        green  = self._reacts_by_color[Color.GREEN ].calculate_weighted_squares_on_user(user_id)
-        yellow = self._reacts_by_color[Color.YELLOW].calculate_weighted_squares_on_user(user_id)
-        red    = self._reacts_by_color[Color.RED   ].calculate_weighted_squares_on_user(user_id)
-        return (+2) * green + (-1) * yellow + (-2) * red
+    def pair_counts(self):
+        for color in Color:
+            for (target_id, source_id, num) in self._reacts_by_color[color].pair_counts():
+                yield (color, target_id, source_id, num)
+
+    def dated_reacts(self):
+        for color in Color:
+            for (timestamp, message_id, target_id, source_id) in self._reacts_by_color[color].dated_reacts():
+                yield (color, timestamp, message_id, target_id, source_id)
+
+    def _initial_pair_counts(self):
+        pair_counts, self._loaded_pair_counts = self._loaded_pair_counts, None
+        if pair_counts is None:
+            return self.pair_counts()
+        return ((color, target_id, source_id, num) for ((color, target_id, source_id), num) in pair_counts.items() if num > 0)
 
     def __getitem__(self, color) -> Reacts:
         return self._reacts_by_color[color]
 
     def _load(self):
         logger.info("load reacts")
-        try:
-            with open(self._filename, 'rb') as f:
-                self._reacts_by_color = pickle.load(f)
-            logger.info("loaded reacts from file: #reacts(%d) #messages(%d) #targets(%d)",
-                sum(len(self._reacts_by_color[color])               for color in Color),
-                sum(len(self._reacts_by_color[color].by_message_id) for color in Color),
-                sum(len(self._reacts_by_color[color].by_target_id)  for color in Color))
-        except FileNotFoundError:
-            self._reacts_by_color = {
-                Color.GREEN  : Reacts(Color.GREEN),
-                Color.YELLOW : Reacts(Color.YELLOW),
-                Color.RED    : Reacts(Color.RED)
-            }
-
-    def _save(self):
-        logger.info("save reacts")
-        with open(self._filename, 'wb') as f:
-            pickle.dump(self._reacts_by_color, f)
+        start = time.perf_counter()
+        snapshot_seq, self._reacts_by_color = _load_reacts_snapshot(self._filename)
+        self._loaded_pair_counts = _load_pair_counts(self._pairs_filename, snapshot_seq)
+        loaded = time.perf_counter()
+        self._seq = _replay_reacts_journal(self._sealed_journal_filename, self._reacts_by_color, snapshot_seq, self._loaded_pair_counts)
+        self._seq = _replay_reacts_journal(self._journal_filename, self._reacts_by_color, self._seq, self._loaded_pair_counts)
+        replayed = time.perf_counter()
+        # build the index by message here, on the loading thread, rather than in the first lookup on the event loop
+        for color in Color:
+            self._reacts_by_color[color]._by_message_id()
+        logger.info("loaded reacts from file: #reacts(%d) #targets(%d) seq(%d) snapshot seq(%d) pair counts(%s) in %.1fms (+%.1fms journal, +%.1fms index)",
+            sum(len(self._reacts_by_color[color]) for color in Color),
+            len(set().union(*(self._reacts_by_color[color].target_ids() for color in Color))),
+            self._seq, snapshot_seq, "saved" if self._loaded_pair_counts is not None else "recounted",
+            (loaded - start) * 1000, (replayed - loaded) * 1000, (time.perf_counter() - replayed) * 1000)
+        self._journal = Journal(self._journal_filename)
+        self._journal.open()
+        if os.path.exists(self._sealed_journal_filename):
+            # a previous compaction didn't finish
+            self._compacting = True
+            self._start_compaction()
+
+    def _compact(self):
+        if self._compacting:
+            return
+        self._compacting = True
+        self._journal.num_records = 0
+        # sealing goes through the persistence thread so that it happens after every append before it
+        seq = self._seq
+        def seal():
+            if os.path.exists(self._sealed_journal_filename):
+                self._compacting = False
+                return # a failed compaction is retried on the next startup
+            logger.info("seal reacts journal at seq(%d)", seq)
+            self._journal.rotate(self._sealed_journal_filename)
+            self._start_compaction()
+        persistence.submit(seal)
+
+    def _start_compaction(self):
+        # The snapshot is rebuilt from disk rather than from live state so that
+        # the event loop can keep mutating reacts while this runs
+        def compact():
+            try:
+                start = time.perf_counter()
+                snapshot_seq, reacts_by_color = _load_reacts_snapshot(self._filename)
+                seq = _replay_reacts_journal(self._sealed_journal_filename, reacts_by_color, snapshot_seq)
+                _save_pair_counts(self._pairs_filename, seq, reacts_by_color)
+                _save_reacts_snapshot(self._filename, seq, reacts_by_color)
+                os.remove(self._sealed_journal_filename)
+                logger.info("compacted reacts snapshot from seq(%d) to seq(%d) in %.1fms", snapshot_seq, seq, (time.perf_counter() - start) * 1000)
+            except Exception:
+                logger.exception("failed to compact reacts snapshot")
+            finally:
+                self._compacting = False
+        threading.Thread(target=compact, name="reacts-compaction", daemon=True).start()
 
 
 @dataclass
@@ -183,57 +1244,287 @@ class Message:
     channel_id: int
     author_id: int
     original_content: str
+    # Not present on messages cached by older versions, see backfill
+    guild_id: Optional[int] = None
+    attachment_url: Optional[str] = None
 
     def __init__(self, discord_message: discord.Message):
         self.id = discord_message.id
         self.channel_id = discord_message.channel.id
         self.author_id = discord_message.author.id
         self.original_content = discord_message.content
+        self.guild_id = discord_message.guild.id if discord_message.guild is not None else None
+        self.attachment_url = discord_message.attachments[0].url if discord_message.attachments else None
+
+    @staticmethod
+    def from_row(id, channel_id, author_id, original_content, guild_id, attachment_url) -> "Message":
+        message = Message.__new__(Message)
+        message.id = id
+        message.channel_id = channel_id
+        message.author_id = author_id
+        message.original_content = original_content
+        message.guild_id = guild_id
+        message.attachment_url = attachment_url
+        return message
+
+    @property
+    def jump_url(self) -> Optional[str]:
+        if self.guild_id is None:
+            return None
+        return f"https://discord.com/channels/{self.guild_id}/{self.channel_id}/{self.id}"
+
+    # Fill in the fields older versions didn't cache, keeping the original content.
+    # Returns whether anything changed.
+    def backfill(self, discord_message: discord.Message) -> bool:
+        if self.guild_id is not None or discord_message.guild is None:
+            return False
+        self.guild_id = discord_message.guild.id
+        self.attachment_url = discord_message.attachments[0].url if discord_message.attachments else None
+        return True
+
+class RecordStore:
+
+    # A keyed, append-only file of pickled records. Only the file offset of
+    # each key's latest record is held in memory, records are read back on
+    # demand. Deletes append a tombstone (an empty record). Appends go through
+    # the persistence thread, and are served from memory until they land.
+
+    HEADER = struct.Struct("<QII") # key, payload length, crc32 of payload
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock() # guards _offsets and _unwritten against the persistence thread
+        self._offsets = {} # key -> (payload offset, payload length)
+        self._unwritten = {} # key -> record, or None for a delete, until it is on disk
+        self._load()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._unwritten:
+                return self._unwritten[key] is not None
+            return key in self._offsets
+
+    def get(self, key):
+        with self._lock:
+            if key in self._unwritten:
+                return self._unwritten[key]
+            location = self._offsets.get(key)
+        if location is None:
+            return None
+        (offset, length) = location
+        return pickle.loads(os.pread(self._reader.fileno(), length, offset))
+
+    # Reads in file order, so a batch costs about one pass over the file rather than a seek per key
+    def get_many(self, keys) -> Dict[int, Any]:
+        records = {}
+        locations = []
+        with self._lock:
+            for key in keys:
+                if key in self._unwritten:
+                    if self._unwritten[key] is not None:
+                        records[key] = self._unwritten[key]
+                elif key in self._offsets:
+                    locations.append((self._offsets[key], key))
+        for ((offset, length), key) in sorted(locations):
+            records[key] = pickle.loads(os.pread(self._reader.fileno(), length, offset))
+        return records
+
+    def keys(self) -> set:
+        with self._lock:
+            keys = set(self._offsets)
+            for key, record in self._unwritten.items():
+                if record is None:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+        return keys
+
+    def __setitem__(self, key, record):
+        self._append(key, record, pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def __delitem__(self, key):
+        self._append(key, None, b"")
+
+    def __len__(self):
+        return len(self.keys())
+
+    def _append(self, key, record, payload):
+        with self._lock:
+            self._unwritten[key] = record
+        def write():
+            start = time.perf_counter()
+            offset = self._writer.tell() + RecordStore.HEADER.size
+            self._writer.write(RecordStore.HEADER.pack(key, len(payload), zlib.crc32(payload)) + payload)
+            self._writer.flush()
+            persistence.record(self._filename, time.perf_counter() - start, RecordStore.HEADER.size + len(payload))
+            with self._lock:
+                if payload:
+                    self._offsets[key] = (offset, len(payload))
+                else:
+                    self._offsets.pop(key, None)
+                if self._unwritten.get(key, record) is record:
+                    self._unwritten.pop(key, None) # unless it has been overwritten again since
+        persistence.submit(write)
+
+    def _load(self):
+        start = time.perf_counter()
+        valid_length = 0
+        garbage = 0
+        try:
+            f = open(self._filename, 'rb')
+        except FileNotFoundError:
+            f = None
+        if f is not None:
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if size > 0:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        for (key, payload_offset, length) in RecordStore._scan(mm, size):
+                            previous = self._offsets.pop(key, None)
+                            if previous is not None:
+                                garbage += RecordStore.HEADER.size + previous[1]
+                            if length > 0:
+                                self._offsets[key] = (payload_offset, length)
+                            else:
+                                garbage += RecordStore.HEADER.size
+                            valid_length = payload_offset + length
+        self._writer = open(self._filename, 'ab')
+        if self._writer.tell() != valid_length:
+            logger.warning("truncate record store(%s) from %d to %d bytes", self._filename, self._writer.tell(), valid_length)
+            self._writer.truncate(valid_length)
+            self._writer.seek(valid_length)
+        self._reader = open(self._filename, 'rb')
+        logger.info("indexed record store(%s): #records(%d) #bytes(%d) #garbage bytes(%d) in %.1fms",
+            self._filename, len(self._offsets), valid_length, garbage, (time.perf_counter() - start) * 1000)
+        if garbage > valid_length // 2 and garbage > 1 << 20:
+            self._compact()
+
+    # Yields (key, payload offset, payload length) for each intact record, up to any torn tail
+    @staticmethod
+    def _scan(mm, size) -> Iterator[Tuple[int, int, int]]:
+        offset = 0
+        while offset + RecordStore.HEADER.size <= size:
+            (key, length, crc) = RecordStore.HEADER.unpack_from(mm, offset)
+            payload_offset = offset + RecordStore.HEADER.size
+            if payload_offset + length > size or zlib.crc32(mm[payload_offset:payload_offset + length]) != crc:
+                return
+            yield (key, payload_offset, length)
+            offset = payload_offset + length
+
+    # The latest record of each key, in file order, without opening the store.
+    # Only offsets are held in memory, so this is safe to run next to the bot.
+    @staticmethod
+    def read(filename) -> Iterator[Tuple[int, Any]]:
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                latest = {} # key -> payload offset of its latest record, None if deleted
+                for (key, payload_offset, length) in RecordStore._scan(mm, size):
+                    latest[key] = payload_offset if length > 0 else None
+                for (key, payload_offset, length) in RecordStore._scan(mm, size):
+                    if length > 0 and latest[key] == payload_offset:
+                        yield (key, pickle.loads(mm[payload_offset:payload_offset + length]))
+
+    # Rewrite the file with only the latest record of each key. Only done on load.
+    def _compact(self):
+        logger.info("compact record store(%s)", self._filename)
+        tmp_filename = self._filename + ".tmp"
+        offsets = {}
+        with open(tmp_filename, 'wb') as f:
+            for key, (offset, length) in self._offsets.items():
+                payload = os.pread(self._reader.fileno(), length, offset)
+                f.write(RecordStore.HEADER.pack(key, length, zlib.crc32(payload)))
+                offsets[key] = (f.tell(), length)
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self._writer.close()
+        self._reader.close()
+        os.replace(tmp_filename, self._filename)
+        self._offsets = offsets
+        self._writer = open(self._filename, 'ab')
+        self._reader = open(self._filename, 'rb')
+
+    # Write a whole store in one go, for migrations
+    @staticmethod
+    def create(filename, records: Iterable[Tuple[int, Any]]):
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'wb') as f:
+            for key, record in records:
+                payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                f.write(RecordStore.HEADER.pack(key, len(payload), zlib.crc32(payload)) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
 
 class MessagesDB:
 
-    def __init__(self):
-        self._filename = os.path.join(DATA_DIR, "messages.data")
+    # Messages live on disk in messages.records, and are only read (content
+    # and all) when asked for
+
+    def __init__(self, data_dir=DATA_DIR):
+        self._filename = os.path.join(data_dir, "messages.records")
+        self._legacy_filename = os.path.join(data_dir, "messages.data")
         self._load()
 
     def __contains__(self, message_id):
-        return message_id in self._messages_by_id
+        return message_id in self._records
 
     def __getitem__(self, message_id):
-        return self._messages_by_id[message_id]
+        message = self.get(message_id)
+        if message is None:
+            raise KeyError(message_id)
+        return message
 
     def get(self, message_id):
-        return self._messages_by_id.get(message_id)
+        row = self._records.get(message_id)
+        return Message.from_row(*row) if row is not None else None
+
+    def get_many(self, message_ids) -> Dict[int, Message]:
+        return { message_id : Message.from_row(*row) for message_id, row in self._records.get_many(message_ids).items() }
 
     def __setitem__(self, message_id, message):
-        self._messages_by_id[message_id] = message
-        self._save()
+        self._records[message_id] = MessagesDB._row(message)
 
     def __delitem__(self, message_id):
-        del self._messages_by_id[message_id]
-        self._save()
+        if message_id not in self._records:
+            raise KeyError(message_id)
+        del self._records[message_id]
+
+    def values(self) -> Iterator[Message]:
+        for message_id in self._records.keys():
+            message = self.get(message_id)
+            if message is not None:
+                yield message
+
+    @staticmethod
+    def _row(message):
+        return (message.id, message.channel_id, message.author_id, message.original_content, message.guild_id, message.attachment_url)
 
     def _load(self):
         logger.info("load message cache")
-        try:
-            with open(self._filename, 'rb') as f:
-                self._messages_by_id = pickle.load(f)
-        except FileNotFoundError:
-            self._messages_by_id = dict()
-
-    def _save(self):
-        logger.info("save message cache")
-        with open(self._filename, 'wb') as f:
-            pickle.dump(self._messages_by_id, f)
+        if not os.path.exists(self._filename) and os.path.exists(self._legacy_filename):
+            logger.info("migrate message cache from %s", self._legacy_filename)
+            with open(self._legacy_filename, 'rb') as f:
+                messages_by_id = pickle.load(f)
+            RecordStore.create(self._filename, ((message_id, MessagesDB._row(message)) for message_id, message in messages_by_id.items()))
+        self._records = RecordStore(self._filename)
 
 
 class MessageFormatter(metaclass=abc.ABCMeta):
 
-    async def format_message(self, message: Message, discord_message: Optional[discord.Message]) -> discord.Embed:
-        return await self._format_message(message, discord_message)
+    async def format_message(self, message: Message, deleted: bool, tally: Dict[Color, int]) -> discord.Embed:
+        return await self._format_message(message, deleted, tally)
 
     @abc.abstractmethod
-    async def _format_message(self, message: Message, discord_message: Optional[discord.Message]) -> discord.Embed:
+    async def _format_message(self, message: Message, deleted: bool, tally: Dict[Color, int]) -> discord.Embed:
         raise NotImplementedError()
 
 
@@ -243,169 +1534,1363 @@ class SquareboardEntry:
     tally: Dict[Color, int]
 
 
-class Squareboard:
+class SquareboardEntriesDB:
 
-    def __init__(self, channel_name, reacts: ReactsDB, messages: MessagesDB, formatter: MessageFormatter):
+    def __init__(self, channel_name, data_dir=DATA_DIR):
         self._channel_name = channel_name
-        self._filename = os.path.join(DATA_DIR, "squareboard.data" if channel_name == "squareboard" else f"squareboard-{channel_name}.data")
-        self._channel = None
-        self._reacts = reacts
-        self._messages = messages
-        self._formatter = formatter
+        self._filename = os.path.join(data_dir, "squareboard.data" if channel_name == "squareboard" else f"squareboard-{channel_name}.data")
         self._load()
 
-    # this can't be done in init for some reason
-    def _ensure_channel(self, bot):
-        if self._channel is None:
-            [ guild ] = bot.guilds
-            [ self._channel ] = [ channel for channel in guild.text_channels if channel.name == self._channel_name ]
+    # The channel names of the squareboards with entries saved in data_dir
+    @staticmethod
+    def channel_names(data_dir=DATA_DIR) -> list[str]:
+        channel_names = []
+        for filename in sorted(os.listdir(data_dir)):
+            if filename == "squareboard.data":
+                channel_names.append("squareboard")
+            elif filename.startswith("squareboard-") and filename.endswith(".data"):
+                channel_names.append(filename[len("squareboard-"):-len(".data")])
+        return channel_names
+
+    def get(self, message_id) -> Optional[SquareboardEntry]:
+        return self._entries_by_id.get(message_id)
+
+    def items(self) -> Iterable[Tuple[int, SquareboardEntry]]:
+        return self._entries_by_id.items()
+
+    def __setitem__(self, message_id, entry: SquareboardEntry):
+        self._entries_by_id[message_id] = entry
+        self._save()
+
+    def __delitem__(self, message_id):
+        del self._entries_by_id[message_id]
+        self._save()
+
+    def _load(self):
+        logger.info("load squareboard(%s)", self._channel_name)
+        try:
+            with open(self._filename, 'rb') as f:
+                self._entries_by_id = pickle.load(f)
+        except FileNotFoundError:
+            self._entries_by_id = dict()
+
+    def _save(self):
+        persistence.save(self._filename, dict(self._entries_by_id))
+
+
+class SqliteDB:
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS reacts (
+            color INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            source_id INTEGER NOT NULL,
+            timestamp REAL,
+            added_at REAL, -- when the react was committed, NULL if from before this was kept
+            PRIMARY KEY (color, message_id, target_id, source_id)
+        );
+        CREATE INDEX IF NOT EXISTS reacts_by_message_id ON reacts (message_id);
+        CREATE INDEX IF NOT EXISTS reacts_by_target_id ON reacts (target_id, color, source_id);
+        CREATE INDEX IF NOT EXISTS reacts_by_source_id ON reacts (source_id);
+        CREATE INDEX IF NOT EXISTS reacts_by_timestamp ON reacts (timestamp);
+        CREATE TABLE IF NOT EXISTS pair_counts (
+            color INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            source_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (color, target_id, source_id)
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            channel_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            original_content TEXT NOT NULL,
+            guild_id INTEGER,
+            attachment_url TEXT
+        );
+        CREATE TABLE IF NOT EXISTS squareboard_entries (
+            channel_name TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            squareboard_message_id INTEGER NOT NULL,
+            green INTEGER NOT NULL,
+            yellow INTEGER NOT NULL,
+            red INTEGER NOT NULL,
+            PRIMARY KEY (channel_name, message_id)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self._data_dir = data_dir
+        self._filename = os.path.join(data_dir, "squares.db")
+        logger.info("open sqlite db(%s)", self._filename)
+        # opened on whichever thread loads the guild, then only used from the event loop
+        self.connection = sqlite3.connect(self._filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SqliteDB.SCHEMA)
+        self._upgrade_schema()
+        self._migrate_from_pickles()
+        self._count_pairs()
+
+    def _upgrade_schema(self):
+        react_columns = { name for (_, name, *_) in self.connection.execute("PRAGMA table_info(reacts)") }
+        message_columns = { name for (_, name, *_) in self.connection.execute("PRAGMA table_info(messages)") }
+        with self.connection:
+            if "added_at" not in react_columns:
+                self.connection.execute("ALTER TABLE reacts ADD COLUMN added_at REAL")
+            if "guild_id" not in message_columns:
+                self.connection.execute("ALTER TABLE messages ADD COLUMN guild_id INTEGER")
+            if "attachment_url" not in message_columns:
+                self.connection.execute("ALTER TABLE messages ADD COLUMN attachment_url TEXT")
+
+    # One-shot import of the .data pickles written by the pickle backend
+    def _migrate_from_pickles(self):
+        if self.connection.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_pickles'").fetchone() is not None:
+            return
+        logger.info("migrate pickles to sqlite")
+        reacts = ReactsDB(self._data_dir)
+        messages = MessagesDB(self._data_dir)
+        with self.connection:
+            for color in Color:
+                (user_ids, *columns) = reacts[color].columns()
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO reacts VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        (color.value, message_id, user_ids[target], user_ids[source], _nan_to_none(timestamp), _nan_to_none(added_at))
+                        for (message_id, target, source, timestamp, added_at) in zip(*columns)
+                    ))
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (message.id, message.channel_id, message.author_id, message.original_content, message.guild_id, message.attachment_url)
+                    for message in messages.values()
+                ))
+            for channel_name in SquareboardEntriesDB.channel_names(self._data_dir):
+                entries = SquareboardEntriesDB(channel_name, self._data_dir)
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO squareboard_entries VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        (channel_name, message_id, entry.squareboard_message_id, entry.tally[Color.GREEN], entry.tally[Color.YELLOW], entry.tally[Color.RED])
+                        for message_id, entry in entries.items()
+                    ))
+            self.connection.execute("INSERT INTO meta VALUES ('migrated_from_pickles', ?)", (datetime.now().isoformat(),))
+        reacts._journal.close()
+        logger.info("migrated pickles to sqlite: #reacts(%d) #messages(%d)",
+            self.connection.execute("SELECT COUNT(*) FROM reacts").fetchone()[0],
+            self.connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0])
+
+    # One-shot fill of pair_counts for databases from before it, after that it
+    # is kept up to date by each commit
+    def _count_pairs(self):
+        if self.connection.execute("SELECT 1 FROM meta WHERE key = 'counted_pairs'").fetchone() is not None:
+            return
+        with self.connection:
+            self.connection.execute("DELETE FROM pair_counts")
+            self.connection.execute("INSERT INTO pair_counts SELECT color, target_id, source_id, COUNT(*) FROM reacts GROUP BY color, target_id, source_id")
+            self.connection.execute("INSERT INTO meta VALUES ('counted_pairs', ?)", (datetime.now().isoformat(),))
+        logger.info("counted pairs: #pairs(%d)", self.connection.execute("SELECT COUNT(*) FROM pair_counts").fetchone()[0])
+
+
+def _to_epoch(timestamp: Optional[datetime]) -> Optional[float]:
+    return timestamp.timestamp() if timestamp is not None else None
+
+def _from_epoch(epoch: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(epoch) if epoch is not None else None
+
+def _nan_to_none(epoch: float) -> Optional[float]:
+    return None if math.isnan(epoch) else epoch
+
+
+class SqliteReactsDB(ReactsStore):
+
+    def __init__(self, db: SqliteDB):
+        self._connection = db.connection
+        self._build_aggregates()
+
+    def _commit(self, react_updates: ReactUpdates):
+        added_at = time.time()
+        applied = ReactUpdates()
+        with self._connection:
+            for (color, react) in react_updates.adds:
+                logger.info(f"add {color} react by {react.source_id} to {react.target_id} on message({react.message_id})")
+                added = self._connection.execute(
+                    "INSERT OR IGNORE INTO reacts VALUES (?, ?, ?, ?, ?, ?)",
+                    (color.value, react.message_id, react.target_id, react.source_id, _to_epoch(react.timestamp), added_at)).rowcount
+                if added:
+                    applied.add(color, react)
+                    self._connection.execute(
+                        "INSERT INTO pair_counts VALUES (?, ?, ?, 1) ON CONFLICT (color, target_id, source_id) DO UPDATE SET count = count + 1",
+                        (color.value, react.target_id, react.source_id))
+            for (color, react) in react_updates.removes:
+                logger.info(f"remove {color} react by {react.source_id} to {react.target_id} on message({react.message_id})")
+                removed = self._connection.execute(
+                    "DELETE FROM reacts WHERE color = ? AND message_id = ? AND target_id = ? AND source_id = ?",
+                    (color.value, react.message_id, react.target_id, react.source_id)).rowcount
+                if removed:
+                    applied.remove(color, react)
+                    self._connection.execute(
+                        "UPDATE pair_counts SET count = count - 1 WHERE color = ? AND target_id = ? AND source_id = ?",
+                        (color.value, react.target_id, react.source_id))
+                    self._connection.execute(
+                        "DELETE FROM pair_counts WHERE color = ? AND target_id = ? AND source_id = ? AND count <= 0",
+                        (color.value, react.target_id, react.source_id))
+        return applied
+
+    def calculate_tally_on_message(self, message_id):
+        tally = { color : 0 for color in Color }
+        for (color, num) in self._connection.execute("SELECT color, COUNT(*) FROM reacts WHERE message_id = ? GROUP BY color", (message_id,)):
+            tally[Color(color)] = num
+        return tally
+
+    def source_ids_on_message(self, message_id):
+        source_ids_by_color = { color : set() for color in Color }
+        for (color, source_id) in self._connection.execute("SELECT color, source_id FROM reacts WHERE message_id = ?", (message_id,)):
+            source_ids_by_color[Color(color)].add(source_id)
+        return source_ids_by_color
+
+    def reacts_on_message(self, color, message_id):
+        return [
+            React(message_id, target_id, source_id, _from_epoch(timestamp))
+            for (target_id, source_id, timestamp) in self._connection.execute(
+                "SELECT target_id, source_id, timestamp FROM reacts WHERE message_id = ? AND color = ?", (message_id, color.value))
+        ]
+
+    def message_counts(self):
+        for (color, message_id, target_id, num) in self._connection.execute("SELECT color, message_id, target_id, COUNT(*) FROM reacts GROUP BY color, message_id, target_id"):
+            yield (Color(color), message_id, target_id, num)
+
+    def pair_counts(self):
+        for (color, target_id, source_id, num) in self._connection.execute("SELECT color, target_id, source_id, count FROM pair_counts"):
+            yield (Color(color), target_id, source_id, num)
+
+    def dated_reacts(self):
+        for (color, timestamp, message_id, target_id, source_id) in self._connection.execute("SELECT color, timestamp, message_id, target_id, source_id FROM reacts WHERE timestamp IS NOT NULL"):
+            yield (Color(color), timestamp, message_id, target_id, source_id)
+
+
+class SqliteMessagesDB:
+
+    def __init__(self, db: SqliteDB):
+        self._connection = db.connection
+
+    def __contains__(self, message_id):
+        return self._connection.execute("SELECT 1 FROM messages WHERE id = ?", (message_id,)).fetchone() is not None
+
+    def __getitem__(self, message_id):
+        message = self.get(message_id)
+        if message is None:
+            raise KeyError(message_id)
+        return message
+
+    def get(self, message_id):
+        row = self._connection.execute("SELECT id, channel_id, author_id, original_content, guild_id, attachment_url FROM messages WHERE id = ?", (message_id,)).fetchone()
+        return Message.from_row(*row) if row is not None else None
+
+    def get_many(self, message_ids) -> Dict[int, Message]:
+        MAX_VARIABLES = 500
+        message_ids = list(message_ids)
+        messages = {}
+        for i in range(0, len(message_ids), MAX_VARIABLES):
+            batch = message_ids[i:i+MAX_VARIABLES]
+            rows = self._connection.execute(
+                f"SELECT id, channel_id, author_id, original_content, guild_id, attachment_url FROM messages WHERE id IN ({', '.join('?' * len(batch))})",
+                batch)
+            for row in rows:
+                messages[row[0]] = Message.from_row(*row)
+        return messages
+
+    def __setitem__(self, message_id, message):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (message_id, message.channel_id, message.author_id, message.original_content, message.guild_id, message.attachment_url))
+
+    def __delitem__(self, message_id):
+        with self._connection:
+            self._connection.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+
+
+class SqliteSquareboardEntriesDB:
+
+    def __init__(self, db: SqliteDB, channel_name):
+        self._connection = db.connection
+        self._channel_name = channel_name
+
+    def get(self, message_id):
+        row = self._connection.execute(
+            "SELECT squareboard_message_id, green, yellow, red FROM squareboard_entries WHERE channel_name = ? AND message_id = ?",
+            (self._channel_name, message_id)).fetchone()
+        if row is None:
+            return None
+        (squareboard_message_id, green, yellow, red) = row
+        return SquareboardEntry(squareboard_message_id, { Color.GREEN : green, Color.YELLOW : yellow, Color.RED : red })
+
+    def __setitem__(self, message_id, entry: SquareboardEntry):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO squareboard_entries VALUES (?, ?, ?, ?, ?, ?)",
+                (self._channel_name, message_id, entry.squareboard_message_id, entry.tally[Color.GREEN], entry.tally[Color.YELLOW], entry.tally[Color.RED]))
+
+    def __delitem__(self, message_id):
+        with self._connection:
+            self._connection.execute("DELETE FROM squareboard_entries WHERE channel_name = ? AND message_id = ?", (self._channel_name, message_id))
+
+
+@dataclass
+class MessageCacheStats:
+    hot_hits: int = 0 # served from memory
+    cold_hits: int = 0 # read from the store
+    misses: int = 0 # in neither
+    prefetched: int = 0 # read from the store ahead of being asked for
+    evictions: int = 0
+
+    def hit_rates(self) -> Tuple[float, float]:
+        lookups = self.hot_hits + self.cold_hits + self.misses
+        if lookups == 0:
+            return (0.0, 0.0)
+        return (self.hot_hits / lookups, self.cold_hits / lookups)
+
+    def __str__(self):
+        (hot_rate, cold_rate) = self.hit_rates()
+        return f"hot({self.hot_hits}, {hot_rate:.1%}) cold({self.cold_hits}, {cold_rate:.1%}) misses({self.misses}) prefetched({self.prefetched}) evictions({self.evictions})"
+
+
+class MessageCache:
+
+    # A bounded LRU of recently used messages in front of a message store.
+    # Writes go through to the store. A message the store doesn't have is
+    # not cached, so a later insert can't be shadowed.
+
+    def __init__(self, store, size=MESSAGE_CACHE_SIZE):
+        self._store = store
+        self._size = size
+        self._hot = OrderedDict() # message id -> Message
+        self.stats = MessageCacheStats()
+
+    def __contains__(self, message_id):
+        return message_id in self._hot or message_id in self._store
+
+    def __getitem__(self, message_id):
+        message = self.get(message_id)
+        if message is None:
+            raise KeyError(message_id)
+        return message
+
+    def get(self, message_id):
+        message = self._hot.get(message_id)
+        if message is not None:
+            self._hot.move_to_end(message_id)
+            self.stats.hot_hits += 1
+            return message
+        message = self._store.get(message_id)
+        if message is None:
+            self.stats.misses += 1
+            return None
+        self.stats.cold_hits += 1
+        self._put(message_id, message)
+        return message
+
+    # Pull any of message_ids not already in memory from the store in one batch
+    def prefetch(self, message_ids):
+        cold_ids = [ message_id for message_id in message_ids if message_id not in self._hot ]
+        if not cold_ids:
+            return
+        messages = self._store.get_many(cold_ids)
+        self.stats.prefetched += len(messages)
+        for message_id, message in messages.items():
+            self._put(message_id, message)
+
+    def __setitem__(self, message_id, message):
+        self._store[message_id] = message
+        self._put(message_id, message)
+
+    def __delitem__(self, message_id):
+        self._hot.pop(message_id, None)
+        del self._store[message_id]
+
+    def _put(self, message_id, message):
+        self._hot[message_id] = message
+        self._hot.move_to_end(message_id)
+        while len(self._hot) > self._size:
+            self._hot.popitem(last=False)
+            self.stats.evictions += 1
+
+    def __len__(self):
+        return len(self._hot)
+
+
+class Storage:
+
+    def __init__(self, reacts: ReactsStore, messages, squareboard_entries: Callable[[str], Any]):
+        self.reacts = reacts
+        self.messages = messages
+        self.squareboard_entries = squareboard_entries
 
-    async def refresh_message(self, bot, discord_message: discord.Message):
+def open_storage(data_dir=DATA_DIR) -> Storage:
+    match STORAGE_BACKEND:
+        case "pickle":
+            return Storage(ReactsDB(data_dir), MessageCache(MessagesDB(data_dir)), lambda channel_name: SquareboardEntriesDB(channel_name, data_dir))
+        case "sqlite":
+            db = SqliteDB(data_dir)
+            return Storage(SqliteReactsDB(db), MessageCache(SqliteMessagesDB(db)), lambda channel_name: SqliteSquareboardEntriesDB(db, channel_name))
+        case _:
+            raise ValueError(f"unknown storage backend({STORAGE_BACKEND})")
 
-        self._ensure_channel(bot)
 
-        message_id = discord_message.id
-        tally = self._reacts.calculate_tally_on_message(message_id)
-        score = self._reacts.calculate_unique_squarers_on_message(message_id)
-        entry = self._entries_by_id.get(message_id)
+class TokenBucket:
 
-        squareboard_message = None
-        if entry is not None:
+    def __init__(self, capacity, period):
+        self._capacity = capacity
+        self._rate = capacity / period
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class SquareboardPublisher:
+
+    # Applies squareboard changes in the background, one worker per channel.
+    # Only the message ids are queued: whatever the state is when the worker
+    # gets to a message is what gets published, so a burst of changes to one
+    # message collapses into a single send, edit or delete.
+
+    def __init__(self):
+        self._pending = defaultdict(dict) # channel id -> { (board, message id) : None }, in arrival order
+        self._wakeups = {} # channel id -> asyncio.Event
+        self._buckets = {} # channel id -> TokenBucket
+        self._workers = {} # channel id -> asyncio.Task
+        self._attempts = {} # (board, message id) -> number of failed attempts
+        self._publishing = 0 # workers in the middle of a publish
+        self._closing = False
+
+    def schedule(self, board: "Squareboard", message_id):
+        if self._closing:
+            logger.warning("squareboard(%s) publisher is closed, dropping message(%d)", board.channel_name, message_id)
+            return
+        channel_id = board.channel.id
+        self._pending[channel_id][(board, message_id)] = None
+        if channel_id not in self._workers:
+            self._wakeups[channel_id] = asyncio.Event()
+            self._buckets[channel_id] = TokenBucket(SQUAREBOARD_RATE_LIMIT, SQUAREBOARD_RATE_LIMIT_PERIOD)
+            self._workers[channel_id] = asyncio.create_task(self._work(channel_id))
+        self._wakeups[channel_id].set()
+
+    async def _work(self, channel_id):
+        pending = self._pending[channel_id]
+        wakeup = self._wakeups[channel_id]
+        bucket = self._buckets[channel_id]
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            while pending:
+                key = next(iter(pending))
+                del pending[key]
+                (board, message_id) = key
+                self._publishing += 1
+                try:
+                    with metrics.time("squares_stage_seconds", stage="board_refresh"):
+                        await board.publish(message_id, bucket)
+                    self._attempts.pop(key, None)
+                except Exception as e:
+                    metrics.count("squares_squareboard_failures_total", board=board.channel_name)
+                    self._retry(key, e)
+                finally:
+                    self._publishing -= 1
+            if self._closing:
+                return # after draining, so a worker that first runs after close still publishes its queue
+
+    def _retry(self, key, e):
+        (board, message_id) = key
+        attempts = self._attempts.get(key, 0) + 1
+        if isinstance(e, discord.errors.Forbidden) or attempts > SQUAREBOARD_MAX_ATTEMPTS:
+            logger.exception("squareboard(%s) gave up on message(%d) after %d attempt(s)", board.channel_name, message_id, attempts)
+            self._attempts.pop(key, None)
+            board.abandon(message_id)
+            return
+        delay = min(SQUAREBOARD_RETRY_DELAY * 2 ** (attempts - 1), 300)
+        logger.warning("squareboard(%s) failed on message(%d), retrying in %.1fs: %s", board.channel_name, message_id, delay, e)
+        self._attempts[key] = attempts
+        asyncio.get_running_loop().call_later(delay, self.schedule, board, message_id)
+
+    # Whether nothing is queued or being published, retries aside
+    def idle(self) -> bool:
+        return self._publishing == 0 and not any(self._pending.values())
+
+    # Publish what is already queued, then stop
+    async def close(self, timeout=10.0):
+        self._closing = True
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.gather(*self._workers.values()), timeout)
+        except asyncio.TimeoutError:
+            # the queued changes, and the one each cancelled worker was publishing
+            unpublished = sum(len(pending) for pending in self._pending.values()) + sum(worker.cancelled() for worker in self._workers.values())
+            logger.warning("squareboard publisher closed with %d change(s) unpublished, they are published when their guild is next loaded", unpublished)
+
+
+@dataclass(frozen=True)
+class SquareboardConfig:
+    channel_name: str
+    colors: frozenset # squarers of these colors count towards the threshold
+    threshold: int # unique squarers needed to be on the board
+
+    # Comma separated "<channel name>:<colors>:<threshold>", with colors joined by "+"
+    # or "all", e.g. "squareboard:all:6,hall-of-shame:red:4"
+    @staticmethod
+    def parse_many(spec: str) -> list["SquareboardConfig"]:
+        configs = []
+        for item in spec.split(","):
             try:
-                squareboard_message = await self._channel.fetch_message(entry.squareboard_message_id)
-            except discord.errors.NotFound:
-                pass
+                (channel_name, colors, threshold) = item.strip().split(":")
+                threshold = int(threshold)
+                if threshold < 1:
+                    raise ValueError() # a message with no reacts left would qualify
+                configs.append(SquareboardConfig(
+                    channel_name,
+                    frozenset(Color) if colors == "all" else frozenset(Color[color.upper()] for color in colors.split("+")),
+                    threshold))
+            except (KeyError, ValueError):
+                raise ValueError(f"bad squareboard({item}), expected <channel name>:<colors>:<threshold>, with a threshold of at least 1, e.g. hall-of-shame:red:4")
+        channel_names = [ config.channel_name for config in configs ]
+        if len(set(channel_names)) != len(channel_names):
+            raise ValueError(f"squareboard channels({spec}) must be distinct")
+        return configs
+
+
+class MessageSquares:
+
+    # What the squareboards need to know about a message as of the latest commit
+    # on it, worked out once and shared by every board: the tally, who squared
+    # it, and the embed, which is only rendered if some board posts or edits.
+
+    def __init__(self, message_id, tally: Dict[Color, int], source_ids_by_color: Dict[Color, Set[int]], messages: MessagesDB, formatter: MessageFormatter):
+        self.message_id = message_id
+        self.tally = tally
+        self._source_ids_by_color = source_ids_by_color
+        self._messages = messages
+        self._formatter = formatter
+        self._embed = None # asyncio.Future
+        self.pending = set() # boards yet to publish this
+
+    def unique_squarers(self, colors) -> int:
+        return len(set().union(*(self._source_ids_by_color[color] for color in colors)))
+
+    async def embed(self) -> discord.Embed:
+        if self._embed is None:
+            message = self._messages[self.message_id]
+            self._embed = asyncio.ensure_future(self._formatter.format_message(message, deleted=False, tally=self.tally))
+        try:
+            return (await asyncio.shield(self._embed)).copy()
+        except Exception:
+            self._embed = None # so a retry renders again
+            raise
+
+
+class SquareboardBacklog:
+
+    # message id -> channel names of the boards it was scheduled for and hasn't
+    # been published to yet, so changes still queued when the bot stops (or that
+    # failed) are published once the guild is loaded again
+
+    def __init__(self, data_dir=DATA_DIR):
+        self._filename = os.path.join(data_dir, "squareboard.backlog")
+        try:
+            with open(self._filename, 'rb') as f:
+                self._channel_names_by_id = pickle.load(f)
+        except FileNotFoundError:
+            self._channel_names_by_id = dict()
+
+    def add(self, message_id, channel_names):
+        self._channel_names_by_id[message_id] = self._channel_names_by_id.get(message_id, frozenset()) | frozenset(channel_names)
+        self._save()
+
+    def discard(self, message_id, channel_name):
+        channel_names = self._channel_names_by_id.get(message_id)
+        if channel_names is None or channel_name not in channel_names:
+            return
+        if channel_names == { channel_name }:
+            del self._channel_names_by_id[message_id]
+        else:
+            self._channel_names_by_id[message_id] = channel_names - { channel_name }
+        self._save()
+
+    def items(self) -> list[Tuple[int, frozenset]]:
+        return list(self._channel_names_by_id.items())
+
+    def __len__(self):
+        return len(self._channel_names_by_id)
+
+    def _save(self):
+        persistence.save(self._filename, dict(self._channel_names_by_id))
+
+
+class Squareboards:
+
+    # A guild's squareboards. A commit fans out to every board from one
+    # MessageSquares, and only the boards whose post has to change are scheduled.
+    # Boards publish whatever the latest MessageSquares of a message is when
+    # they get to it, which is dropped once every board scheduled for it is done.
+
+    def __init__(self, configs: list[SquareboardConfig], storage: Storage, formatter: MessageFormatter, publisher: SquareboardPublisher, backlog: SquareboardBacklog):
+        self._reacts = storage.reacts
+        self._messages = storage.messages
+        self._formatter = formatter
+        self.boards = [ Squareboard(config, self, storage.squareboard_entries(config.channel_name), publisher) for config in configs ]
+        self._squares = {} # message id -> MessageSquares
+        self._backlog = backlog
+
+    def _calculate_squares(self, message_id, tally=None) -> MessageSquares:
+        if tally is None:
+            tally = self._reacts.calculate_tally_on_message(message_id)
+        return MessageSquares(message_id, tally, self._reacts.source_ids_on_message(message_id), self._messages, self._formatter)
+
+    # Call after every commit on the message
+    def refresh_message(self, guild, message_id, tally: Optional[Dict[Color, int]] = None):
+        squares = self._calculate_squares(message_id, tally)
+        self._squares.pop(message_id, None)
+        for board in self.boards:
+            if board.needs_publish(squares) and board._ensure_channel(guild):
+                squares.pending.add(board)
+        if squares.pending:
+            self._squares[message_id] = squares
+            self._backlog.add(message_id, (board.channel_name for board in squares.pending))
+            for board in squares.pending:
+                board.schedule(message_id)
+
+    # Call once the guild is loaded, to schedule what wasn't published before
+    # the bot last stopped
+    def resume(self, guild):
+        boards = { board.channel_name : board for board in self.boards if board._ensure_channel(guild) }
+        scheduled = 0
+        for (message_id, channel_names) in self._backlog.items():
+            for channel_name in channel_names:
+                board = boards.get(channel_name)
+                if board is None:
+                    self._backlog.discard(message_id, channel_name) # the board is gone
+                else:
+                    board.schedule(message_id)
+                    scheduled += 1
+        if scheduled:
+            logger.info("resume %d unpublished squareboard change(s) in guild(%d)", scheduled, guild.id)
+
+    def squares(self, message_id) -> MessageSquares:
+        squares = self._squares.get(message_id)
+        if squares is None:
+            squares = self._calculate_squares(message_id) # a retry, after the boards it was scheduled for were done
+        return squares
+
+    def published(self, board: "Squareboard", squares: MessageSquares, done: bool):
+        squares.pending.discard(board)
+        if done:
+            self.forget(board, squares.message_id)
+        if not squares.pending and self._squares.get(squares.message_id) is squares:
+            del self._squares[squares.message_id]
+
+    # Drop the message from the backlog of the board, unless a later commit
+    # has scheduled the board again
+    def forget(self, board: "Squareboard", message_id):
+        latest = self._squares.get(message_id)
+        if latest is None or board not in latest.pending:
+            self._backlog.discard(message_id, board.channel_name)
+
+
+class Squareboard:
+
+    def __init__(self, config: SquareboardConfig, squareboards: Squareboards, entries: SquareboardEntriesDB, publisher: SquareboardPublisher):
+        self.config = config
+        self.channel_name = config.channel_name
+        self.channel = None
+        self._squareboards = squareboards
+        self._entries = entries
+        self._publisher = publisher
+
+    # this can't be done in init, the guild's channels may not be known yet
+    def _ensure_channel(self, guild) -> bool:
+        if self.channel is None:
+            channels = [ channel for channel in guild.text_channels if channel.name == self.channel_name ]
+            if not channels:
+                return False # this guild doesn't have the board
+            [ self.channel ] = channels
+        return True
+
+    def schedule(self, message_id):
+        self._publisher.schedule(self, message_id)
+
+    # Called when the publisher gives up on the message
+    def abandon(self, message_id):
+        self._squareboards.forget(self, message_id)
+
+    def _qualifies(self, squares: MessageSquares) -> bool:
+        return squares.unique_squarers(self.config.colors) >= self.config.threshold
+
+    def needs_publish(self, squares: MessageSquares) -> bool:
+        entry = self._entries.get(squares.message_id)
+        if entry is None:
+            return self._qualifies(squares)
+        return not self._qualifies(squares) or entry.tally != squares.tally
+
+    # Bring the squareboard post for a message in line with its current reacts
+    async def publish(self, message_id, bucket: TokenBucket):
+        squares = self._squareboards.squares(message_id)
+        done = False
+        try:
+            await self._publish(squares, bucket)
+            done = True
+        finally:
+            self._squareboards.published(self, squares, done)
+
+    async def _publish(self, squares: MessageSquares, bucket: TokenBucket):
+
+        message_id = squares.message_id
+        tally = squares.tally
+        entry = self._entries.get(message_id)
 
         async def insert():
-            logger.info("squareboard insert message(%s) tally(%s)", message_id, tally)
-            message = self._messages[message_id]
-            embed = await self._formatter.format_message(message, discord_message)
-            squareboard_message = await self._channel.send(embed=embed)
-            self._entries_by_id[message_id] = SquareboardEntry(squareboard_message.id, tally)
-            self._save()
+            logger.info("squareboard(%s) insert message(%s) tally(%s)", self.channel_name, message_id, tally)
+            embed = await squares.embed()
+            await bucket.acquire()
+            squareboard_message = await self.channel.send(embed=embed)
+            metrics.count("squares_squareboard_updates_total", board=self.channel_name, action="insert")
+            self._entries[message_id] = SquareboardEntry(squareboard_message.id, tally)
 
         async def delete():
-            logger.info("squareboard delete message(%s) tally(%s)", message_id, tally)
-            await squareboard_message.delete()
-            del self._entries_by_id[message_id]
-            self._save()
+            logger.info("squareboard(%s) delete message(%s) tally(%s)", self.channel_name, message_id, tally)
+            await bucket.acquire()
+            try:
+                await self.channel.get_partial_message(entry.squareboard_message_id).delete()
+                metrics.count("squares_squareboard_updates_total", board=self.channel_name, action="delete")
+            except discord.errors.NotFound:
+                pass
+            del self._entries[message_id]
 
         async def amend():
-            logger.info("squareboard amend message(%s) tally(%s)", message_id, tally)
-            message = self._messages[message_id]
-            embed = await self._formatter.format_message(message, discord_message)
-            await squareboard_message.edit(embed=embed)
-            self._entries_by_id[message_id].tally = tally
-            self._save()
+            logger.info("squareboard(%s) amend message(%s) tally(%s)", self.channel_name, message_id, tally)
+            embed = await squares.embed()
+            await bucket.acquire()
+            try:
+                await self.channel.get_partial_message(entry.squareboard_message_id).edit(embed=embed)
+                metrics.count("squares_squareboard_updates_total", board=self.channel_name, action="amend")
+            except discord.errors.NotFound:
+                logger.info("squareboard(%s) message(%s) is gone, reinserting message(%s)", self.channel_name, entry.squareboard_message_id, message_id)
+                await insert()
+                return
+            self._entries[message_id] = SquareboardEntry(entry.squareboard_message_id, tally)
 
-        if squareboard_message is None:
-            if score >= SQUAREBOARD_SCORE_THRESHOLD:
+        if entry is None:
+            if self._qualifies(squares):
                 await insert()
         else:
-            if score < SQUAREBOARD_SCORE_THRESHOLD:
+            if not self._qualifies(squares):
                 await delete()
             elif tally != entry.tally:
                 await amend()
 
 
-    def _load(self):
-        logger.info("load squareboard(%s)", self._channel_name)
+class CogABCMeta(commands.CogMeta, abc.ABCMeta):
+    pass
+
+
+class KeyedLock:
+
+    # One asyncio.Lock per key, dropped again once nobody holds or waits on it
+
+    def __init__(self):
+        self._locks = {} # key -> (lock, number of holders and waiters)
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key):
+        lock, users = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, users + 1)
+        start = time.perf_counter()
+        try:
+            async with lock:
+                metrics.observe("squares_stage_seconds", time.perf_counter() - start, stage="lock_wait")
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+    def locked(self, key):
+        return key in self._locks
+
+    def __len__(self):
+        return len(self._locks)
+
+
+@dataclass
+class UserResolverStats:
+    hits: int = 0
+    negative_hits: int = 0 # cached "not found"
+    misses: int = 0
+    fetches: int = 0 # misses that needed a REST call
+    evictions: int = 0
+
+
+class UserResolver:
+
+    # An LRU of user id -> user (or None if not found), with entries expiring
+    # after a TTL. Filled from the guild member cache on startup, and from
+    # bounded concurrent fetch_user calls after that.
+
+    def __init__(self, bot):
+        self._bot = bot
+        self._cache = OrderedDict() # user id -> (user or None, expiry time)
+        self._fetches = {} # user id -> in flight fetch
+        self._semaphore = asyncio.Semaphore(USER_FETCH_CONCURRENCY)
+        self.stats = UserResolverStats()
+
+    async def prime(self, guilds):
+        for guild in guilds:
+            if self._bot.intents.members and not guild.chunked:
+                await guild.chunk()
+            for member in guild.members:
+                self._put(member.id, member)
+        logger.info("primed user cache with %d user(s)", len(self._cache))
+
+    async def resolve(self, user_id) -> Optional[discord.abc.User]:
+        if user_id is None:
+            return None
+        cached = self._cache.get(user_id)
+        if cached is not None:
+            (user, expires_at) = cached
+            if time.monotonic() < expires_at:
+                self._cache.move_to_end(user_id)
+                if user is None:
+                    self.stats.negative_hits += 1
+                else:
+                    self.stats.hits += 1
+                return user
+            del self._cache[user_id]
+        self.stats.misses += 1
+        user = self._bot.get_user(user_id)
+        if user is not None:
+            self._put(user_id, user)
+            return user
+        fetch = self._fetches.get(user_id)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self._fetch(user_id))
+            self._fetches[user_id] = fetch
+            fetch.add_done_callback(lambda _: self._fetches.pop(user_id, None))
+        return await asyncio.shield(fetch)
+
+    async def resolve_many(self, user_ids) -> Dict[int, Optional[discord.abc.User]]:
+        user_ids = list(user_ids)
+        users = await asyncio.gather(*(self.resolve(user_id) for user_id in user_ids))
+        return dict(zip(user_ids, users))
+
+    async def _fetch(self, user_id):
+        async with self._semaphore:
+            self.stats.fetches += 1
+            user = None
+            try:
+                with metrics.time("squares_stage_seconds", stage="fetch", call="fetch_user"):
+                    user = await self._bot.fetch_user(user_id)
+            except discord.errors.NotFound:
+                logger.debug("user(%d) not found", user_id)
+            self._put(user_id, user)
+            return user
+
+    def _put(self, user_id, user):
+        ttl = USER_CACHE_TTL if user is not None else USER_CACHE_NEGATIVE_TTL
+        self._cache[user_id] = (user, time.monotonic() + ttl)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > USER_CACHE_SIZE:
+            self._cache.popitem(last=False)
+            self.stats.evictions += 1
+
+    def __len__(self):
+        return len(self._cache)
+
+
+@dataclass
+class CoalescingStats:
+    events: int = 0 # square react events received
+    passes: int = 0 # times the react state of a message was updated
+    folded: int = 0 # events handled in the same pass as an earlier event
+
+@dataclass
+class BackfillStats:
+    channels: int = 0
+    messages: int = 0 # messages scanned
+    reconciled: int = 0 # messages whose reacts were out of date
+    skipped: int = 0 # messages left alone because a live event got to them first
+    adds: int = 0
+    removes: int = 0
+    commits: int = 0
+    seconds: float = 0.0
+
+    def rate(self):
+        return self.messages / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return (f"#channels({self.channels}) #messages({self.messages}) #reconciled({self.reconciled}) #skipped({self.skipped}) "
+            f"#adds({self.adds}) #removes({self.removes}) #commits({self.commits}) in {self.seconds:.1f}s ({self.rate():.1f} messages/s)")
+
+
+class BackfillCheckpoints:
+
+    # channel id -> id of the newest message scanned and committed in that channel
+
+    def __init__(self, data_dir=DATA_DIR):
+        self._filename = os.path.join(data_dir, "backfill.data")
         try:
             with open(self._filename, 'rb') as f:
-                self._entries_by_id = pickle.load(f)
+                self._checkpoints = pickle.load(f)
         except FileNotFoundError:
-            self._entries_by_id = dict()
+            self._checkpoints = dict()
 
-    def _save(self):
-        logger.info("save squareboard(%s)", self._channel_name)
-        with open(self._filename, 'wb') as f:
-            pickle.dump(self._entries_by_id, f)
+    def get(self, channel_id):
+        return self._checkpoints.get(channel_id)
 
+    def __setitem__(self, channel_id, message_id):
+        self._checkpoints[channel_id] = message_id
+        self._save()
 
+    def __delitem__(self, channel_id):
+        if self._checkpoints.pop(channel_id, None) is not None:
+            self._save()
+
+    def _save(self):
+        # not persistence.save: that can write ahead of journal records submitted
+        # before it, and a checkpoint must never get ahead of the reacts it covers
+        persistence.submit(functools.partial(_atomic_pickle_dump, self._filename, dict(self._checkpoints)))
+
+
+class GuildState:
+
+    # Everything kept for one guild: its own store (in data/guilds/<guild id>),
+    # squareboards and lock domain. Nothing here is shared with other guilds.
+
+    def __init__(self, guild_id, data_dir, squareboard_configs: list[SquareboardConfig], formatter: MessageFormatter, publisher: SquareboardPublisher):
+        self.guild_id = guild_id
+        storage = open_storage(data_dir)
+        self.reacts = storage.reacts
+        self.messages = storage.messages
+        self.squareboards = Squareboards(squareboard_configs, storage, formatter, publisher, SquareboardBacklog(data_dir))
+        # Writers are serialized per message. Store commits are synchronous, so readers
+        # never see a half applied commit as long as they copy what they need out of the
+        # store without awaiting in between, and need no lock at all.
+        self.message_locks = KeyedLock()
+        self.synced_at = {} # message id -> time.monotonic() of the last full read of its reacts
+        self.backfill_checkpoints = BackfillCheckpoints(data_dir)
+
+    def needs_resync(self, message_id):
+        synced_at = self.synced_at.get(message_id)
+        return synced_at is None or time.monotonic() - synced_at > RESYNC_INTERVAL
+
+
+# Files a single guild bot kept directly in DATA_DIR
+def _legacy_data_files() -> list[str]:
+    try:
+        filenames = os.listdir(DATA_DIR)
+    except FileNotFoundError:
+        return []
+    return [
+        filename for filename in filenames
+        if filename.startswith(("reacts.", "messages.", "squares.db", "squareboard", "backfill.")) and os.path.isfile(os.path.join(DATA_DIR, filename))
+    ]
 
-class CogABCMeta(commands.CogMeta, abc.ABCMeta):
-    pass
 
 class Squares(MessageFormatter, commands.Cog, metaclass=CogABCMeta):
 
     def __init__(self, bot):
         self._bot = bot
-        self._reacts = ReactsDB()
-        self._messages = MessagesDB()
-        self._squareboard = Squareboard(SQUAREBOARD_CHANNEL_NAME, self._reacts, self._messages, self)
-        self._users_by_id = {}
-        self._lock = asyncio.Lock()
-
-    def _user_ids(self):
-        return set().union(*(set(self._reacts[color].by_target_id.keys()) for color in Color))
+        self._squareboard_configs = SquareboardConfig.parse_many(SQUAREBOARDS)
+        self._squareboard_publisher = SquareboardPublisher()
+        self._guilds = {} # guild id -> GuildState
+        self._guild_loads = {} # guild id -> in flight load
+        self._users = UserResolver(bot)
+        self._channels_by_id = {}
+        self._message_fetch_semaphore = asyncio.Semaphore(MESSAGE_FETCH_CONCURRENCY)
+        self._embeds = OrderedDict() # message id -> (render key, embed), see _format_message
+        self._pending_reactions = {} # message id -> react events waiting to be handled
+        self._tasks = set()
+        self.coalescing_stats = CoalescingStats()
+        self._backfill_tasks = {} # guild id -> backfill task
+        self._metrics_server = None
+
+    # A guild's state is loaded the first time it is needed, off the event loop,
+    # so a guild that is still loading doesn't hold up the others
+    async def _guild(self, guild_id) -> GuildState:
+        state = self._guilds.get(guild_id)
+        if state is not None:
+            return state
+        load = self._guild_loads.get(guild_id)
+        if load is None:
+            adopt_legacy_data = len(self._bot.guilds) == 1
+            load = asyncio.ensure_future(asyncio.to_thread(self._load_guild, guild_id, adopt_legacy_data))
+            self._guild_loads[guild_id] = load
+        # the load stays in _guild_loads until its state is in _guilds, so that
+        # no caller in between sees neither and loads the guild a second time
+        try:
+            state = await asyncio.shield(load)
+        except Exception:
+            if self._guild_loads.get(guild_id) is load:
+                del self._guild_loads[guild_id] # so the next call tries again
+            raise
+        if guild_id not in self._guilds:
+            self._guilds[guild_id] = state
+            del self._guild_loads[guild_id]
+            guild = self._bot.get_guild(guild_id)
+            if guild is not None:
+                state.squareboards.resume(guild)
+        return self._guilds[guild_id]
+
+    def _load_guild(self, guild_id, adopt_legacy_data) -> GuildState:
+        start = time.perf_counter()
+        data_dir = os.path.join(DATA_DIR, "guilds", str(guild_id))
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+            legacy_files = _legacy_data_files()
+            if legacy_files and adopt_legacy_data:
+                # the bot used to serve exactly one guild, keeping its state directly in DATA_DIR
+                logger.info("move single guild state into guild(%d): %s", guild_id, legacy_files)
+                for filename in legacy_files:
+                    os.replace(os.path.join(DATA_DIR, filename), os.path.join(data_dir, filename))
+            elif legacy_files:
+                logger.warning("not moving single guild state into guild(%d), the bot is in more than one guild", guild_id)
+        state = GuildState(guild_id, data_dir, self._squareboard_configs, self, self._squareboard_publisher)
+        logger.info("loaded guild(%d) in %.1fms", guild_id, (time.perf_counter() - start) * 1000)
+        return state
 
     # A list of users and their tallies, ordered by decreasing score
-    async def _calculate_summary(self):
-        async with self._lock:
-            summary = [
-                (user, self._reacts.calculate_tally_on_user(user_id), self._reacts.calculate_weighted_squares_on_user(user_id))
-                for user_id in self._user_ids()
-                if not self._should_hide_user(user_id)
-                if (user := await self._try_fetch_user(user_id)) is not None
-            ]
-        summary.sort(key=lambda entry: entry[2], reverse=True)
-        return summary
+    async def _calculate_summary(self, state: GuildState, window: Optional[Window] = None):
+        # the ranking is copied out in one go, so no lock is needed to see a consistent state
+        if window is None:
+            ranking = state.reacts.leaderboard.ranking()
+        else:
+            ranking = Leaderboard(state.reacts.calendar.pair_counts(window.start, window.end)).ranking()
+        ranking = [ entry for entry in ranking if not self._should_hide_user(entry[0]) ]
+        users = await self._users.resolve_many(user_id for (user_id, _, _) in ranking)
+        return [
+            (user, tally, score)
+            for (user_id, tally, score) in ranking
+            if (user := users[user_id]) is not None
+        ]
+
+    async def _calculate_react_updates(self, state: GuildState, discord_message, timestamp) -> ReactUpdates:
+        source_ids_by_color = await self._read_square_sources(discord_message)
+        with metrics.time("squares_stage_seconds", stage="diff"):
+            return self._diff_reacts(state, discord_message.id, discord_message.author.id, source_ids_by_color, timestamp)
 
-    async def _calculate_react_updates(self, discord_message, timestamp) -> ReactUpdates:
+    # The sources of each color of square on a message, according to discord
+    async def _read_square_sources(self, discord_message, rate_limit: Optional[TokenBucket] = None) -> Dict[Color, Set[int]]:
         def source_is_valid(source):
             if discord_message.author.id == source.id:
                 return False # don't count self reacts
             if source.bot and source.id != self._bot.user.id:
                 return False # don't count bots (except us)
             return True
-        react_updates = ReactUpdates()
-        for color in Color:
-            desired_source_ids = set()
-            for reaction in discord_message.reactions:
-                if isinstance(reaction.emoji, str) and reaction.emoji == COLOR_TO_SQUARE[color]:
+        source_ids_by_color = { color : set() for color in Color }
+        for reaction in discord_message.reactions:
+            if isinstance(reaction.emoji, str) and reaction.emoji in SQUARE_TO_COLOR:
+                if rate_limit is not None:
+                    await rate_limit.acquire()
+                with metrics.time("squares_stage_seconds", stage="fetch", call="reaction_users"):
                     async for source in reaction.users():
                         if source_is_valid(source):
-                            desired_source_ids.add(source.id)
-                    break
-            current_source_ids = { react.source_id for react in self._reacts[color].by_message_id[discord_message.id] }
+                            source_ids_by_color[SQUARE_TO_COLOR[reaction.emoji]].add(source.id)
+        return source_ids_by_color
+
+    def _diff_reacts(self, state: GuildState, message_id, author_id, source_ids_by_color: Dict[Color, Set[int]], timestamp) -> ReactUpdates:
+        react_updates = ReactUpdates()
+        for color in Color:
+            desired_source_ids = source_ids_by_color[color]
+            current_reacts = state.reacts.reacts_on_message(color, message_id)
+            current_source_ids = { react.source_id for react in current_reacts }
             for source_id in desired_source_ids:
                 if source_id not in current_source_ids:
-                    react = React(discord_message.id, discord_message.author.id, source_id, timestamp)
+                    react = React(message_id, author_id, source_id, timestamp)
                     react_updates.add(color, react)
-            for react in self._reacts[color].by_message_id[discord_message.id]:
+            for react in current_reacts:
                 if react.source_id not in desired_source_ids:
                     react_updates.remove(color, react)
         return react_updates
 
+    # The react update described by a burst of gateway events on one message, without
+    # asking discord for the message. Returns None if the events alone aren't enough to tell.
+    def _calculate_react_delta(self, state: GuildState, ctxs, message: Message, timestamp) -> Optional[ReactUpdates]:
+        existing = {
+            (color, react.source_id) : react
+            for color in Color
+            for react in state.reacts.reacts_on_message(color, message.id)
+        }
+        present = { key : True for key in existing }
+        for ctx in ctxs:
+            if ctx.user_id == message.author_id:
+                continue # don't count self reacts
+            key = (SQUARE_TO_COLOR[ctx.emoji.name], ctx.user_id)
+            if ctx.event_type == "REACTION_ADD":
+                if ctx.member is None:
+                    return None # can't tell if the source is a bot
+                if ctx.member.bot and ctx.member.id != self._bot.user.id:
+                    continue # don't count bots (except us)
+                present[key] = True
+            else:
+                present[key] = False
+        react_updates = ReactUpdates()
+        for (color, source_id), is_present in present.items():
+            react = existing.get((color, source_id))
+            if is_present and react is None:
+                react_updates.add(color, React(message.id, message.author_id, source_id, timestamp))
+            elif not is_present and react is not None:
+                react_updates.remove(color, react)
+        return react_updates
+
     async def _on_reaction_upd(self, ctx):
-        color = SQUARE_TO_COLOR.get(ctx.emoji.name)
-        if color is None: # ignore non-square reacts
+        if ctx.emoji.name not in SQUARE_TO_COLOR: # ignore non-square reacts
+            return
+        if ctx.guild_id is None: # squares only count in guilds
             return
-        channel = await self._bot.fetch_channel(ctx.channel_id)
-        discord_message = await channel.fetch_message(ctx.message_id)
-        if await self._try_fetch_user(discord_message.author.id) is None:
-            logger.info(f"ignore {color} react on unknown user({discord_message.author.id})")
+        self.coalescing_stats.events += 1
+        pending = self._pending_reactions.get(ctx.message_id)
+        if pending is not None:
+            pending.append(ctx)
             return
-        async with self._lock:
-            react_updates = await self._calculate_react_updates(discord_message, datetime.now())
+        self._pending_reactions[ctx.message_id] = [ ctx ]
+        self._spawn(self._flush_reactions(ctx.message_id))
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task) # the event loop only keeps a weak reference
+        task.add_done_callback(self._tasks.discard)
+
+    # Gives other events on the same message a chance to arrive, then handles them all in one pass
+    async def _flush_reactions(self, message_id):
+        await asyncio.sleep(REACT_COALESCE_WINDOW)
+        ctxs = self._pending_reactions.pop(message_id)
+        self.coalescing_stats.passes += 1
+        self.coalescing_stats.folded += len(ctxs) - 1
+        if len(ctxs) > 1:
+            logger.info("coalesced %d react events on message(%d): %s", len(ctxs), message_id, self.coalescing_stats)
+        try:
+            with metrics.time("squares_reaction_seconds"):
+                await self._on_reactions_upd(ctxs)
+        except Exception:
+            logger.exception("failed to handle react events on message(%d)", message_id)
+
+    async def _on_reactions_upd(self, ctxs):
+        [ ctx, *_ ] = ctxs
+        state = await self._guild(ctx.guild_id)
+        # fast path: the message is known and has been fully read recently, so the events are the whole story
+        message = state.messages.get(ctx.message_id)
+        if message is not None and not state.needs_resync(ctx.message_id):
+            if await self._users.resolve(message.author_id) is None:
+                logger.info(f"ignore react on unknown user({message.author_id})")
+                return
+            async with state.message_locks(ctx.message_id):
+                message = state.messages.get(ctx.message_id) # may have been dropped while waiting
+                with metrics.time("squares_stage_seconds", stage="diff"):
+                    react_updates = self._calculate_react_delta(state, ctxs, message, datetime.now()) if message is not None else None
+                if react_updates is not None:
+                    metrics.count("squares_reaction_passes_total", path="fast")
+                    if react_updates:
+                        await self._commit(state, message.id, message.author_id, react_updates)
+                    return
+        # slow path: read every square react on the message
+        metrics.count("squares_reaction_passes_total", path="slow")
+        with metrics.time("squares_stage_seconds", stage="fetch", call="fetch_message"):
+            channel = await self._bot.fetch_channel(ctx.channel_id)
+            discord_message = await channel.fetch_message(ctx.message_id)
+        if await self._users.resolve(discord_message.author.id) is None:
+            logger.info(f"ignore react on unknown user({discord_message.author.id})")
+            return
+        async with state.message_locks(discord_message.id):
+            react_updates = await self._calculate_react_updates(state, discord_message, datetime.now())
+            state.synced_at[discord_message.id] = time.monotonic()
+            message = state.messages.get(discord_message.id)
+            if message is not None and message.backfill(discord_message):
+                state.messages[message.id] = message
             if react_updates:
-                await self._commit(discord_message, react_updates)
+                await self._commit(state, discord_message.id, discord_message.author.id, react_updates, discord_message)
 
-    async def _commit(self, discord_message, react_updates):
+    async def _commit(self, state: GuildState, message_id, author_id, react_updates, discord_message: Optional[discord.Message] = None):
         # 1. update react state
-        self._reacts.commit(react_updates)
+        state.reacts.commit(react_updates)
+        self._after_commit(state, message_id, author_id, discord_message)
+
+    def _after_commit(self, state: GuildState, message_id, author_id, discord_message: Optional[discord.Message]):
+        self._embeds.pop(message_id, None)
         # 2. update message state
         # enforce invariant: message exists in cache iff at least one square react is observed
-        tally = self._reacts.calculate_tally_on_message(discord_message.id)
+        tally = state.reacts.calculate_tally_on_message(message_id)
         if any(tally[color] for color in Color):
-            if discord_message.id not in self._messages:
-                self._messages[discord_message.id] = Message(discord_message)
+            if message_id not in state.messages:
+                state.messages[message_id] = Message(discord_message)
         else:
-            if discord_message.id in self._messages:
-                del self._messages[discord_message.id]
+            if message_id in state.messages:
+                del state.messages[message_id]
+            state.synced_at.pop(message_id, None)
         # 3. update squareboard
-        if not self._should_hide_user(discord_message.author.id):
-            await self._squareboard.refresh_message(self._bot, discord_message)
+        if not self._should_hide_user(author_id):
+            guild = self._bot.get_guild(state.guild_id)
+            if guild is not None:
+                state.squareboards.refresh_message(guild, message_id, tally)
+
+    # Scan channel histories, each from its checkpoint, and bring the stored reacts
+    # of every message scanned in line with discord
+    async def _backfill(self, state: GuildState, channels) -> BackfillStats:
+        stats = BackfillStats()
+        semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+        rate_limit = TokenBucket(BACKFILL_RATE_LIMIT, BACKFILL_RATE_LIMIT_PERIOD)
+        start = time.perf_counter()
+        async def scan(channel):
+            async with semaphore:
+                try:
+                    await self._backfill_channel(state, channel, rate_limit, stats, start)
+                except discord.errors.Forbidden:
+                    logger.warning("backfill: no access to channel(%d)", channel.id)
+                except Exception:
+                    logger.exception("backfill: failed on channel(%d)", channel.id)
+                stats.channels += 1
+        await asyncio.gather(*(scan(channel) for channel in channels))
+        stats.seconds = time.perf_counter() - start
+        logger.info("backfill: done: %s", stats)
+        return stats
+
+    async def _backfill_channel(self, state: GuildState, channel, rate_limit, stats, start):
+        checkpoint = state.backfill_checkpoints.get(channel.id)
+        after = discord.Object(id=checkpoint) if checkpoint is not None else None
+        batch = []
+        async for discord_message in channel.history(limit=None, after=after, oldest_first=True):
+            stats.messages += 1
+            if not any(isinstance(reaction.emoji, str) and reaction.emoji in SQUARE_TO_COLOR for reaction in discord_message.reactions):
+                source_ids_by_color = { color : set() for color in Color }
+            elif await self._users.resolve(discord_message.author.id) is None:
+                source_ids_by_color = None # leave it be, as _on_reactions_upd would
+            else:
+                source_ids_by_color = await self._read_square_sources(discord_message, rate_limit)
+            batch.append((discord_message, source_ids_by_color, time.monotonic()))
+            if len(batch) >= BACKFILL_BATCH_SIZE:
+                self._commit_backfill(state, channel.id, batch, stats)
+                batch = []
+                stats.seconds = time.perf_counter() - start
+                logger.info("backfill: channel(%d) up to message(%d): %s", channel.id, discord_message.id, stats)
+        if batch:
+            self._commit_backfill(state, channel.id, batch, stats)
+
+    # One store commit for the whole batch, then the checkpoint
+    def _commit_backfill(self, state: GuildState, channel_id, batch, stats):
+        react_updates = ReactUpdates()
+        updated = []
+        for (discord_message, source_ids_by_color, read_at) in batch:
+            message_id = discord_message.id
+            if source_ids_by_color is None:
+                continue
+            if message_id in self._pending_reactions or state.message_locks.locked(message_id) or state.synced_at.get(message_id, -math.inf) > read_at:
+                stats.skipped += 1 # a live event has a newer view of it
+                continue
+            # when a react was added isn't known, so use the earliest it could have been
+            timestamp = discord_message.created_at.astimezone().replace(tzinfo=None)
+            with metrics.time("squares_stage_seconds", stage="diff"):
+                message_updates = self._diff_reacts(state, message_id, discord_message.author.id, source_ids_by_color, timestamp)
+            if any(source_ids_by_color.values()):
+                state.synced_at[message_id] = read_at
+                message = state.messages.get(message_id)
+                if message is not None and message.backfill(discord_message):
+                    state.messages[message_id] = message
+            if message_updates:
+                react_updates.extend(message_updates)
+                updated.append(discord_message)
+                stats.adds += len(message_updates.adds)
+                stats.removes += len(message_updates.removes)
+        if react_updates:
+            state.reacts.commit(react_updates)
+            stats.commits += 1
+            stats.reconciled += len(updated)
+            for discord_message in updated:
+                self._after_commit(state, discord_message.id, discord_message.author.id, discord_message)
+        state.backfill_checkpoints[channel_id] = batch[-1][0].id
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await self._users.prime(self._bot.guilds)
+
+    async def cog_load(self):
+        metrics.register(self._collect_metrics)
+        if metrics.enabled:
+            self._metrics_server = await asyncio.start_server(self._serve_metrics, METRICS_HOST, METRICS_PORT)
+            logger.info("serving metrics on %s:%d", METRICS_HOST, METRICS_PORT)
+
+    async def cog_unload(self):
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            await self._metrics_server.wait_closed()
+        metrics.unregister(self._collect_metrics)
+        await self._squareboard_publisher.close()
+        await asyncio.to_thread(persistence.flush)
+        for state in self._guilds.values():
+            logger.info("guild(%d) message cache: %s", state.guild_id, state.messages.stats)
+
+    # Tell the user what was wrong with their arguments, e.g. a bad period. Having
+    # this handler stops the bot logging errors, so log the rest here.
+    async def cog_command_error(self, ctx, error):
+        if isinstance(error, commands.CommandInvokeError):
+            error = error.original # raised in the body of a prefix command
+        if isinstance(error, (commands.UserInputError, commands.CheckFailure)):
+            await ctx.send(str(error), ephemeral=True)
+        else:
+            logger.error("command(%s) failed", ctx.command, exc_info=error)
+
+    # Stats kept by the cog and its parts, for Metrics.render
+    def _collect_metrics(self):
+        for (prefix, stats) in (("squares_react_events", self.coalescing_stats), ("squares_user_cache", self._users.stats)):
+            for field in fields(stats):
+                yield (f"{prefix}_{field.name}_total", "counter", {}, getattr(stats, field.name))
+        for state in list(self._guilds.values()):
+            labels = { "guild" : state.guild_id }
+            for field in fields(state.messages.stats):
+                yield (f"squares_message_cache_{field.name}_total", "counter", labels, getattr(state.messages.stats, field.name))
+            yield ("squares_message_cache_size", "gauge", labels, len(state.messages))
+            yield ("squares_message_locks", "gauge", labels, len(state.message_locks))
+        for (filename, stats) in list(persistence.stats.items()):
+            labels = { "file" : os.path.relpath(filename, DATA_DIR) }
+            yield ("squares_persistence_saves_total", "counter", labels, stats.saves)
+            yield ("squares_persistence_coalesced_total", "counter", labels, stats.coalesced)
+            yield ("squares_persistence_bytes_total", "counter", labels, stats.bytes)
+            yield ("squares_persistence_seconds_total", "counter", labels, stats.seconds)
+        yield ("squares_user_cache_size", "gauge", {}, len(self._users))
+        yield ("squares_pending_reactions", "gauge", {}, len(self._pending_reactions))
+        yield ("squares_guilds_loaded", "gauge", {}, len(self._guilds))
+
+    # Just enough HTTP for a prometheus scrape of /metrics
+    async def _serve_metrics(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass # headers
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                (status, body) = ("200 OK", metrics.render().encode())
+            else:
+                (status, body) = ("404 Not Found", b"not found\n")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, ctx):
@@ -423,78 +2908,221 @@ class Squares(MessageFormatter, commands.Cog, metaclass=CogABCMeta):
         )
         await ctx.send(embed=embed)
 
-    async def _try_fetch_user(self, user_id) -> Optional[discord.User]:
-        if user_id is None:
-            return None
-        if user_id in self._users_by_id:
-            return self._users_by_id[user_id]
-        user = None
-        try:
-            user = await self._bot.fetch_user(user_id)
-        except discord.errors.NotFound:
-            logger.debug("user(%d) not found", user_id)
-        self._users_by_id[user_id] = user
-        return user
+    async def _try_fetch_channel(self, channel_id):
+        channel = self._bot.get_channel(channel_id) or self._channels_by_id.get(channel_id)
+        if channel is None:
+            channel = await self._bot.fetch_channel(channel_id)
+            self._channels_by_id[channel_id] = channel
+        return channel
 
     async def _try_fetch_discord_message(self, message: Message) -> Optional[discord.Message]:
-        try:
-            channel = await self._bot.fetch_channel(message.channel_id)
-            discord_message = await channel.fetch_message(message.id)
-        except discord.errors.NotFound:
-            discord_message = None
+        async with self._message_fetch_semaphore:
+            try:
+                with metrics.time("squares_stage_seconds", stage="fetch", call="fetch_message"):
+                    channel = await self._try_fetch_channel(message.channel_id)
+                    discord_message = await channel.fetch_message(message.id)
+            except discord.errors.NotFound:
+                discord_message = None
         return discord_message
 
     def _should_hide_user(self, user_id):
         return user_id in HIDDEN_USER_IDS
 
-    async def _top(self, ctx, color, author_filter):
-        async with self._lock:
-            message_ids_and_counts = [
-                (message_id, len(reacts))
-                for message_id, reacts in self._reacts[color].by_message_id.items()
-                if len(reacts) > 0
-                if (author_filter is None or next(iter(reacts)).target_id == author_filter.id)
-            ]
-        message_ids = map(lambda p:p[0], sorted(message_ids_and_counts, key=lambda p:p[1], reverse=True))
+    def _parse_window(self, period: Optional[str]) -> Optional[Window]:
+        if period is None or period.strip().lower() in ("all", "all-time"):
+            return None
+        return Window.parse(period, epoch_day(time.time()))
+
+    async def _top(self, ctx, color, author_filter, window: Optional[Window] = None):
         MAX_ENTRIES = 10
-        embeds = []
-        for message_id in message_ids:
-            message = self._messages.get(message_id)
-            if message is None:
-                continue
-            if self._should_hide_user(message.author_id):
-                continue
-            discord_message = await self._try_fetch_discord_message(message)
-            async with self._lock:
-                embed = await self._format_message(message, discord_message)
-            embeds.append(embed)
-            if len(embeds) >= MAX_ENTRIES:
+        state = await self._guild(ctx.guild.id)
+        messages = []
+        target_id = author_filter.id if author_filter is not None else None
+        if window is None:
+            ranking = iter(state.reacts.top_messages.ranking(color, target_id))
+        else:
+            ranking = iter(state.reacts.calendar.message_ranking(color, window.start, window.end, target_id))
+        while len(messages) < MAX_ENTRIES:
+            candidates = list(itertools.islice(ranking, 2 * MAX_ENTRIES)) # some may be hidden or missing
+            if not candidates:
                 break
+            state.messages.prefetch(candidates)
+            for message_id in candidates:
+                message = state.messages.get(message_id)
+                if message is None:
+                    continue
+                if self._should_hide_user(message.author_id):
+                    continue
+                messages.append(message)
+                if len(messages) >= MAX_ENTRIES:
+                    break
+        logger.debug("guild(%d) message cache: %s", state.guild_id, state.messages.stats)
+        async def render(message):
+            tally = state.reacts.calculate_tally_on_message(message.id) # read before any await, see GuildState.message_locks
+            discord_message = await self._try_fetch_discord_message(message)
+            if discord_message is not None and message.backfill(discord_message):
+                # the message may have been deleted while fetching, so don't write it back then
+                async with state.message_locks(message.id):
+                    if message.id in state.messages:
+                        state.messages[message.id] = message
+            return await self._format_message(message, deleted=(discord_message is None), tally=tally)
+        embeds = await asyncio.gather(*(render(message) for message in messages))
         await self._send_embeds(ctx, embeds)
 
     @commands.hybrid_command()
-    async def topred(self, ctx, author: discord.User = None):
+    @commands.guild_only()
+    async def topred(self, ctx, author: Optional[discord.User] = None, period: Optional[str] = None):
+        window = self._parse_window(period)
         await ctx.defer()
-        await self._top(ctx, Color.RED, author)
+        await self._top(ctx, Color.RED, author, window)
 
     @commands.hybrid_command()
-    async def topyellow(self, ctx, author: discord.User = None):
+    @commands.guild_only()
+    async def topyellow(self, ctx, author: Optional[discord.User] = None, period: Optional[str] = None):
+        window = self._parse_window(period)
         await ctx.defer()
-        await self._top(ctx, Color.YELLOW, author)
+        await self._top(ctx, Color.YELLOW, author, window)
 
     @commands.hybrid_command()
-    async def topgreen(self, ctx, author: discord.User = None):
+    @commands.guild_only()
+    async def topgreen(self, ctx, author: Optional[discord.User] = None, period: Optional[str] = None):
+        window = self._parse_window(period)
         await ctx.defer()
-        await self._top(ctx, Color.GREEN, author)
+        await self._top(ctx, Color.GREEN, author, window)
+
+    # Who squared the target, and how much each of them adds to the target's score
+    async def _calculate_breakdown(self, state: GuildState, target_id, window: Optional[Window] = None):
+        pairs = state.reacts.leaderboard.pairs if window is None else PairCounts(state.reacts.calendar.pair_counts(window.start, window.end))
+        tally_by_source_id = defaultdict(lambda: { color : 0 for color in Color })
+        for color in Color:
+            for (source_id, num) in pairs.sources(color, target_id).items():
+                tally_by_source_id[source_id][color] = num
+        breakdown = sorted(
+            (
+                (source_id, tally, sum(COLOR_TO_WEIGHT[color] * math.sqrt(num) for color, num in tally.items()))
+                for (source_id, tally) in tally_by_source_id.items()
+                if not self._should_hide_user(source_id)
+            ),
+            key=lambda entry: (-sum(entry[1].values()), -entry[2]))
+        users = await self._users.resolve_many(source_id for (source_id, _, _) in breakdown)
+        return [
+            (user, tally, contribution)
+            for (source_id, tally, contribution) in breakdown
+            if (user := users[source_id]) is not None
+        ]
+
+    # The users the given user exchanges squares with, by decreasing squares exchanged
+    async def _calculate_rivals(self, state: GuildState, user_id):
+        pairs = state.reacts.leaderboard.pairs
+        given = defaultdict(lambda: { color : 0 for color in Color })
+        received = defaultdict(lambda: { color : 0 for color in Color })
+        for color in Color:
+            for (target_id, num) in pairs.targets(color, user_id).items():
+                given[target_id][color] = num
+            for (source_id, num) in pairs.sources(color, user_id).items():
+                received[source_id][color] = num
+        rival_ids = sorted(
+            (rival_id for rival_id in given.keys() | received.keys() if not self._should_hide_user(rival_id)),
+            key=lambda rival_id: (-sum(given[rival_id].values()) - sum(received[rival_id].values()), rival_id))
+        users = await self._users.resolve_many(rival_ids)
+        return [
+            (user, given[rival_id], received[rival_id])
+            for rival_id in rival_ids
+            if (user := users[rival_id]) is not None
+        ]
+
+    @staticmethod
+    def _format_tally(tally: Dict[Color, int]) -> str:
+        return f"{tally[Color.GREEN]}🟩 {tally[Color.YELLOW]}🟨 {tally[Color.RED]}🟥"
+
+    @commands.hybrid_command()
+    @commands.guild_only()
+    async def squares(self, ctx, user: Optional[discord.User] = None, period: Optional[str] = None):
+        window = self._parse_window(period)
+        await ctx.defer()
+        state = await self._guild(ctx.guild.id)
+        if user is not None:
+            breakdown = await self._calculate_breakdown(state, user.id, window)
+            rows = [
+                f"{i+1}. {source.name}: {self._format_tally(tally)} ({contribution:+.1f})"
+                for (i, (source, tally, contribution)) in enumerate(breakdown)
+            ]
+            title = f"Squares on {user.name}"
+            description = "All-time squares by who gave them." if window is None else f"Squares by who gave them for {window.description}."
+        else:
+            summary = await self._calculate_summary(state, window)
+            rows = [
+                f"{i+1}. {user.name}: {self._format_tally(tally)} ({score})"
+                for (i, (user, tally, score)) in enumerate(summary)
+            ]
+            title = "Squares"
+            description = "All-time user behaviour statistics." if window is None else f"User behaviour statistics for {window.description}."
+        await self._send_rows(ctx, title, description, rows)
 
     @commands.hybrid_command()
-    async def squares(self, ctx):
+    @commands.guild_only()
+    async def rivals(self, ctx, user: Optional[discord.User] = None):
+        user = user or ctx.author
         await ctx.defer()
-        summary = await self._calculate_summary()
+        rivals = await self._calculate_rivals(await self._guild(ctx.guild.id), user.id)
         rows = [
-            f"{i+1}. {user.name}: {tally[Color.GREEN]}🟩 {tally[Color.YELLOW]}🟨 {tally[Color.RED]}🟥 ({score})"
-            for (i, (user, tally, score)) in enumerate(summary)
+            f"{i+1}. {rival.name}: gave {self._format_tally(given)}, got {self._format_tally(received)}"
+            for (i, (rival, given, received)) in enumerate(rivals)
+        ]
+        await self._send_rows(ctx, f"Rivals of {user.name}", f"All-time squares {user.name} gave to and got from each user.", rows)
+
+    @commands.hybrid_command()
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def backfill(self, ctx, channel: Optional[discord.TextChannel] = None, restart: bool = False):
+        task = self._backfill_tasks.get(ctx.guild.id)
+        if task is not None and not task.done():
+            await ctx.send("A backfill is already running.")
+            return
+        await ctx.defer()
+        state = await self._guild(ctx.guild.id)
+        channels = [ channel ] if channel is not None else ctx.guild.text_channels
+        channels = [ channel for channel in channels if channel.permissions_for(ctx.guild.me).read_message_history ]
+        if restart:
+            for channel in channels:
+                del state.backfill_checkpoints[channel.id]
+        await ctx.send(f"Backfilling {len(channels)} channel(s).")
+        task = self._backfill_tasks[ctx.guild.id] = asyncio.create_task(self._backfill(state, channels))
+        stats = await task
+        # a slash command's interaction may have expired by now, so reply in the channel
+        await ctx.channel.send(f"Backfill done: {stats}")
+
+    @commands.hybrid_command()
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx):
+        await ctx.defer()
+        state = await self._guild(ctx.guild.id)
+        embed = discord.Embed(title="Squares stats")
+        if metrics.enabled:
+            def describe(name, labels):
+                return " ".join((name.removeprefix("squares_"), *(str(value) for (key, value) in sorted(labels, key=lambda label: label[0] != "stage"))))
+            rows = [
+                f"{describe(name, labels)}: n={count} p50={p50 * 1000:.1f}ms p99={p99 * 1000:.1f}ms"
+                for (name, labels, count, p50, p99) in metrics.histograms()
+            ]
+            rows += [ f"{describe(name, labels)}: {num}" for (name, labels, num) in metrics.counters() ]
+            embed.add_field(name="Timings", value="```" + ("\n".join(rows) or "nothing yet")[:1000] + "```", inline=False)
+        else:
+            embed.add_field(name="Timings", value="Off, set METRICS_PORT to turn them on.", inline=False)
+        embed.add_field(name="React events", value=str(self.coalescing_stats), inline=False)
+        embed.add_field(name="User cache", value=f"{len(self._users)} user(s), {self._users.stats}", inline=False)
+        embed.add_field(name="Message cache", value=f"{len(state.messages)} message(s), {state.messages.stats}", inline=False)
+        data_dir = os.path.join(DATA_DIR, "guilds", str(state.guild_id))
+        saves = [
+            f"{os.path.relpath(filename, data_dir)}: {stats.saves} save(s), {stats.bytes} bytes, {stats.seconds:.2f}s"
+            for (filename, stats) in list(persistence.stats.items())
+            if os.path.dirname(filename) == data_dir
         ]
+        embed.add_field(name="Persistence", value="\n".join(saves) or "nothing written yet", inline=False)
+        await ctx.send(embed=embed)
+
+    async def _send_rows(self, ctx, title, description, rows: list[str]):
         MAX_PAGE_LENGTH = 255 - 2*len("```")
         embeds = []
         i = 0
@@ -507,8 +3135,8 @@ class Squares(MessageFormatter, commands.Cog, metaclass=CogABCMeta):
                 i += 1
             assert len(page) <= MAX_PAGE_LENGTH
             embed = discord.Embed(
-                title="Squares",
-                description="All-time user behaviour statistics."
+                title=title,
+                description=description
             )
             embed.add_field(name="```"+page+"```", value="", inline=False)
             embeds.append(embed)
@@ -526,8 +3154,29 @@ class Squares(MessageFormatter, commands.Cog, metaclass=CogABCMeta):
         else:
             await Paginator.Simple().start(ctx, pages=embeds)
 
-    async def _format_message(self, message: Message, discord_message: Optional[discord.Message]) -> discord.Embed:
-        tally = self._reacts.calculate_tally_on_message(message.id)
+    # Embeds are cached per message for as long as everything they show stays the same
+    async def _format_message(self, message: Message, deleted: bool, tally: Dict[Color, int]) -> discord.Embed:
+        author = await self._users.resolve(message.author_id)
+        key = (
+            tuple(tally[color] for color in Color),
+            author.name if author is not None else None,
+            author.avatar.url if author is not None and author.avatar is not None else None,
+            deleted,
+            message.attachment_url,
+            message.jump_url,
+        )
+        cached = self._embeds.get(message.id)
+        if cached is not None and cached[0] == key:
+            self._embeds.move_to_end(message.id)
+            return cached[1].copy()
+        embed = self._render_message(message, deleted, tally, author)
+        self._embeds[message.id] = (key, embed)
+        self._embeds.move_to_end(message.id)
+        while len(self._embeds) > EMBED_CACHE_SIZE:
+            self._embeds.popitem(last=False)
+        return embed.copy()
+
+    def _render_message(self, message: Message, deleted: bool, tally, author) -> discord.Embed:
         match max(Color, key=lambda color: tally[color]):
             case Color.RED:
                 embed_color = discord.Colour.red()
@@ -539,22 +3188,19 @@ class Squares(MessageFormatter, commands.Cog, metaclass=CogABCMeta):
             description = message.original_content,
             colour = embed_color
         )
-        if discord_message is not None:
-            author = discord_message.author
-        else:
-            author = await self._try_fetch_user(message.author_id)
         if author is None:
             embed.set_author(name=message.author_id)
         else:
             embed.set_author(name=author.name, icon_url=(author.avatar.url if author.avatar is not None else None))
         tally_str = ' '.join([ str(tally[color]) + " " + COLOR_TO_SQUARE[color] for color in Color if tally[color] > 0 ])
         embed.add_field(name="Squares", value=tally_str, inline=False)
-        if discord_message is None:
+        if deleted:
             embed.add_field(name="Original", value=f"[Deleted]", inline=False)
         else:
-            if discord_message.attachments:
-                embed.set_thumbnail(url=discord_message.attachments[0].url)
-            embed.add_field(name="Original", value=f"[Jump!]({discord_message.jump_url})", inline=False)
+            if message.attachment_url is not None:
+                embed.set_thumbnail(url=message.attachment_url)
+            if message.jump_url is not None:
+                embed.add_field(name="Original", value=f"[Jump!]({message.jump_url})", inline=False)
         return embed
 
 
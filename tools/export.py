@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+# Exports a guild's reacts, messages, squareboard entries and leaderboard as
+# chunked CSV, JSON Lines or Parquet files, plus a manifest.json. Everything is
+# streamed straight from the files the bot writes, so the bot can keep running
+# and memory doesn't grow with the length of the history. With --since, only
+# reacts the bot recorded after that time are exported (removes aren't), along
+# with the messages they are on; the manifest's "until" is the --since for the
+# next run. That is when the react was committed (added_at), not its timestamp,
+# which backfill sets to when the message was posted. Reacts recorded before
+# added_at was kept fall back to their timestamp.
+# Parquet needs pyarrow (pip install pyarrow), which the bot itself doesn't.
+#
+#   python tools/export.py data/guilds/<guild id> exports/full --format parquet
+#   python tools/export.py data/guilds/<guild id> exports/2024-06 --since 2024-06-01 --format csv
+
+import argparse
+import csv
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import pickle
+import sqlite3
+import sys
+import time
+from array import array
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import features.squares as squares
+from features.squares import Color, Journal, Leaderboard, RecordStore, SquareboardEntriesDB
+
+CHUNK_ROWS = 1_000_000 # rows per file
+SQLITE_FETCH_ROWS = 10_000
+
+TABLES = {
+    "reacts" : [ ("color", "string"), ("message_id", "uint64"), ("target_id", "uint64"), ("source_id", "uint64"), ("timestamp", "float64"), ("added_at", "float64") ],
+    "messages" : [ ("id", "uint64"), ("channel_id", "uint64"), ("author_id", "uint64"), ("original_content", "string"), ("guild_id", "uint64"), ("attachment_url", "string") ],
+    "squareboard_entries" : [ ("channel_name", "string"), ("message_id", "uint64"), ("squareboard_message_id", "uint64"), ("green", "uint32"), ("yellow", "uint32"), ("red", "uint32") ],
+    "leaderboard" : [ ("rank", "uint32"), ("user_id", "uint64"), ("green", "uint32"), ("yellow", "uint32"), ("red", "uint32"), ("score", "int64") ],
+}
+
+
+class ChunkedWriter:
+
+    # Writes a table as <table>-00000.<extension>, <table>-00001.<extension>, ...
+    # starting a new file every chunk_rows rows
+
+    extension = None
+
+    def __init__(self, out_dir, table, chunk_rows):
+        self._out_dir = out_dir
+        self._table = table
+        self._columns = TABLES[table]
+        self._chunk_rows = chunk_rows
+        self._rows_in_chunk = 0
+        self.filenames = []
+        self.num_rows = 0
+
+    def write(self, row):
+        if not self.filenames or self._rows_in_chunk >= self._chunk_rows:
+            if self.filenames:
+                self._close()
+            self.filenames.append(f"{self._table}-{len(self.filenames):05d}.{self.extension}")
+            self._open(os.path.join(self._out_dir, self.filenames[-1]))
+            self._rows_in_chunk = 0
+        self._write(row)
+        self._rows_in_chunk += 1
+        self.num_rows += 1
+
+    def close(self):
+        if self.filenames:
+            self._close()
+
+    def _open(self, filename):
+        raise NotImplementedError()
+
+    def _write(self, row):
+        raise NotImplementedError()
+
+    def _close(self):
+        raise NotImplementedError()
+
+
+class CsvWriter(ChunkedWriter):
+
+    extension = "csv"
+
+    def _open(self, filename):
+        self._file = open(filename, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(name for (name, _) in self._columns)
+
+    def _write(self, row):
+        self._writer.writerow("" if value is None else value for value in row)
+
+    def _close(self):
+        self._file.close()
+
+
+class JsonLinesWriter(ChunkedWriter):
+
+    extension = "jsonl"
+
+    def _open(self, filename):
+        self._file = open(filename, 'w', encoding='utf-8')
+
+    def _write(self, row):
+        self._file.write(json.dumps({ name : value for ((name, _), value) in zip(self._columns, row) }, ensure_ascii=False))
+        self._file.write("\n")
+
+    def _close(self):
+        self._file.close()
+
+
+class ParquetWriter(ChunkedWriter):
+
+    # A chunk is buffered column-wise and written as one file, so memory is
+    # bounded by chunk_rows
+
+    extension = "parquet"
+
+    def __init__(self, out_dir, table, chunk_rows):
+        super().__init__(out_dir, table, chunk_rows)
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([ (name, getattr(pyarrow, type)()) for (name, type) in self._columns ])
+
+    def _open(self, filename):
+        self._filename = filename
+        self._buffer = [ [] for _ in self._columns ]
+
+    def _write(self, row):
+        for (column, value) in zip(self._buffer, row):
+            column.append(value)
+
+    def _close(self):
+        self._pyarrow.parquet.write_table(self._pyarrow.Table.from_arrays(self._buffer, schema=self._schema), self._filename)
+        self._buffer = None
+
+WRITERS = {
+    "csv" : CsvWriter,
+    "jsonl" : JsonLinesWriter,
+    "parquet" : ParquetWriter,
+}
+
+
+class SnapshotChanged(Exception):
+    pass
+
+# The reacts journalled since a snapshot, folded into the final state of each
+# react they touch: (color, message_id, target_id, source_id) -> (state, epoch, added_at).
+# KEEP means the react was added, so it is either in the snapshot already
+# (which wins, like Reacts._insert) or is new with this timestamp.
+KEEP, ADDED, REMOVED = range(3)
+
+def _inode(filename):
+    try:
+        return os.stat(filename).st_ino
+    except FileNotFoundError:
+        return None
+
+def _read_journals(data_dir, snapshot_seq) -> dict:
+    changes = {}
+    seq = snapshot_seq
+    # a rotation between reading the sealed journal and the live one moves
+    # records into the sealed one after it was read, with no gap in the seqs
+    inode = _inode(os.path.join(data_dir, "reacts.log"))
+    for filename in ("reacts.log.old", "reacts.log"):
+        for record in Journal.read(os.path.join(data_dir, filename)):
+            (record_seq, adds, removes) = record[:3]
+            if record_seq <= seq:
+                continue
+            if record_seq != seq + 1:
+                raise SnapshotChanged() # compacted since the snapshot was opened
+            added_at = squares._nan_to_none(squares._journal_record_added_at(record))
+            for (color, message_id, target_id, source_id, timestamp) in adds:
+                key = (color, message_id, target_id, source_id)
+                (state, _, _) = changes.get(key, (None, None, None))
+                if state is None:
+                    changes[key] = (KEEP, squares._to_epoch(timestamp), added_at)
+                elif state == REMOVED:
+                    changes[key] = (ADDED, squares._to_epoch(timestamp), added_at)
+            for (color, message_id, target_id, source_id, _) in removes:
+                changes[(color, message_id, target_id, source_id)] = (REMOVED, None, None)
+            seq = record_seq
+    if _inode(os.path.join(data_dir, "reacts.log")) != inode:
+        raise SnapshotChanged() # rotated while being read
+    return changes
+
+# (color, message_id, target_id, source_id, epoch or None, added_at or None) for every react in a pickle backend store
+def pickle_reacts(data_dir):
+    for _ in range(10):
+        try:
+            yield from _pickle_reacts(data_dir)
+            return
+        except SnapshotChanged:
+            time.sleep(1.0)
+    raise RuntimeError("the reacts snapshot kept changing under the export")
+
+def _pickle_reacts(data_dir):
+    filename = os.path.join(data_dir, "reacts.data")
+    try:
+        f = open(filename, 'rb')
+    except FileNotFoundError:
+        f = None
+    typecodes = squares._reacts_snapshot_columns(f.read(len(squares.REACTS_SNAPSHOT_MAGIC))) if f is not None else None
+    if typecodes is None:
+        if f is not None:
+            f.close()
+        yield from _loaded_pickle_reacts(data_dir)
+        return
+    with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        (_, seq) = squares.REACTS_SNAPSHOT_HEADER.unpack_from(mm, 0)
+        changes = _read_journals(data_dir, seq)
+        offset = squares.REACTS_SNAPSHOT_HEADER.size
+        sizes = []
+        for color in Color:
+            sizes.append(squares.REACTS_SNAPSHOT_COLOR_HEADER.unpack_from(mm, offset))
+            offset += squares.REACTS_SNAPSHOT_COLOR_HEADER.size
+        kept = set()
+        with memoryview(mm) as view:
+            for color, (num_users, num_rows) in zip(Color, sizes):
+                user_ids = array('Q')
+                user_ids.frombytes(view[offset:offset + num_users * user_ids.itemsize])
+                offset += num_users * user_ids.itemsize
+                columns = []
+                for typecode in typecodes[1:]:
+                    length = num_rows * array(typecode).itemsize
+                    columns.append(view[offset:offset + length].cast(typecode))
+                    offset += length
+                # snapshots from before added_at
+                added_at = columns[4] if len(columns) > 4 else itertools.repeat(math.nan, num_rows)
+                try:
+                    for (message_id, target, source, timestamp, added) in zip(*columns[:4], added_at):
+                        key = (color.value, message_id, user_ids[target], user_ids[source])
+                        (state, _, _) = changes.get(key, (None, None, None))
+                        if state == KEEP:
+                            kept.add(key)
+                        elif state is not None:
+                            continue
+                        yield (color, message_id, key[2], key[3], squares._nan_to_none(timestamp), squares._nan_to_none(added))
+                finally:
+                    for column in columns:
+                        column.release()
+    for (key, (state, timestamp, added_at)) in changes.items():
+        if state == ADDED or (state == KEEP and key not in kept):
+            (color, message_id, target_id, source_id) = key
+            yield (Color(color), message_id, target_id, source_id, timestamp, added_at)
+
+# Snapshots from before memory mapping have to be loaded whole
+def _loaded_pickle_reacts(data_dir):
+    inode = _inode(os.path.join(data_dir, "reacts.log"))
+    seq, reacts_by_color = squares._load_reacts_snapshot(os.path.join(data_dir, "reacts.data"))
+    seq = squares._replay_reacts_journal(os.path.join(data_dir, "reacts.log.old"), reacts_by_color, seq)
+    squares._replay_reacts_journal(os.path.join(data_dir, "reacts.log"), reacts_by_color, seq)
+    if _inode(os.path.join(data_dir, "reacts.log")) != inode:
+        raise SnapshotChanged() # rotated while being read, see _read_journals
+    for color in Color:
+        (user_ids, *columns) = reacts_by_color[color].columns()
+        for (message_id, target, source, timestamp, added_at) in zip(*columns):
+            yield (color, message_id, user_ids[target], user_ids[source], squares._nan_to_none(timestamp), squares._nan_to_none(added_at))
+
+# Message rows, as MessagesDB stores them
+def pickle_messages(data_dir):
+    filename = os.path.join(data_dir, "messages.records")
+    legacy_filename = os.path.join(data_dir, "messages.data")
+    if not os.path.exists(filename) and os.path.exists(legacy_filename):
+        with open(legacy_filename, 'rb') as f:
+            messages_by_id = pickle.load(f)
+        for message in messages_by_id.values():
+            yield squares.MessagesDB._row(message)
+        return
+    for (_, row) in RecordStore.read(filename):
+        yield row
+
+def pickle_squareboard_entries(data_dir):
+    for channel_name in SquareboardEntriesDB.channel_names(data_dir):
+        for (message_id, entry) in SquareboardEntriesDB(channel_name, data_dir).items():
+            yield (channel_name, message_id, entry.squareboard_message_id, entry.tally[Color.GREEN], entry.tally[Color.YELLOW], entry.tally[Color.RED])
+
+
+def _fetch(cursor):
+    while rows := cursor.fetchmany(SQLITE_FETCH_ROWS):
+        yield from rows
+
+def sqlite_reacts(connection, since):
+    if since is None:
+        cursor = connection.execute("SELECT color, message_id, target_id, source_id, timestamp, added_at FROM reacts")
+    else:
+        cursor = connection.execute("SELECT color, message_id, target_id, source_id, timestamp, added_at FROM reacts WHERE IFNULL(added_at, timestamp) > ?", (since,))
+    for (color, message_id, target_id, source_id, timestamp, added_at) in _fetch(cursor):
+        yield (Color(color), message_id, target_id, source_id, timestamp, added_at)
+
+def sqlite_messages(connection):
+    return _fetch(connection.execute("SELECT id, channel_id, author_id, original_content, guild_id, attachment_url FROM messages"))
+
+def sqlite_squareboard_entries(connection):
+    return _fetch(connection.execute("SELECT channel_name, message_id, squareboard_message_id, green, yellow, red FROM squareboard_entries"))
+
+
+# When the react was recorded, as far as --since is concerned
+def recorded_at(react) -> Optional[float]:
+    (_, _, _, _, timestamp, added_at) = react
+    return added_at if added_at is not None else timestamp
+
+def parse_since(text) -> float:
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad time({text}), expected epoch seconds or an ISO date or datetime")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", help="a guild's data directory, e.g. data/guilds/<guild id>")
+    parser.add_argument("out_dir")
+    parser.add_argument("--format", choices=WRITERS.keys(), default="csv")
+    parser.add_argument("--since", type=parse_since, help="only reacts recorded after this, as epoch seconds or an ISO date or datetime (local time)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    os.makedirs(args.out_dir, exist_ok=True)
+    writer_type = WRITERS[args.format]
+    start = time.perf_counter()
+
+    connection = None
+    if os.path.exists(os.path.join(args.data_dir, "squares.db")):
+        connection = sqlite3.connect(f"file:{os.path.join(args.data_dir, 'squares.db')}?mode=ro", uri=True)
+        connection.execute("BEGIN") # one read transaction, so the tables are exported as of the same moment
+        reacts = sqlite_reacts(connection, args.since)
+        messages = sqlite_messages(connection)
+        squareboard_entries = sqlite_squareboard_entries(connection)
+    else:
+        reacts = (react for react in pickle_reacts(args.data_dir) if args.since is None or (recorded_at(react) or -math.inf) > args.since)
+        messages = pickle_messages(args.data_dir)
+        squareboard_entries = pickle_squareboard_entries(args.data_dir)
+
+    writers = {}
+    until = args.since
+    pair_counts = Counter()
+    message_ids = set() if args.since is not None else None
+    writer = writers["reacts"] = writer_type(args.out_dir, "reacts", args.chunk_rows)
+    for react in reacts:
+        (color, message_id, target_id, source_id, timestamp, added_at) = react
+        writer.write((color.name.lower(), message_id, target_id, source_id, timestamp, added_at))
+        pair_counts[(color, target_id, source_id)] += 1
+        if message_ids is not None:
+            message_ids.add(message_id)
+        recorded = recorded_at(react)
+        if recorded is not None and (until is None or recorded > until):
+            until = recorded
+    writer.close()
+
+    writer = writers["messages"] = writer_type(args.out_dir, "messages", args.chunk_rows)
+    for row in messages:
+        if message_ids is None or row[0] in message_ids:
+            writer.write(row)
+    writer.close()
+
+    writer = writers["squareboard_entries"] = writer_type(args.out_dir, "squareboard_entries", args.chunk_rows)
+    for row in squareboard_entries:
+        writer.write(row)
+    writer.close()
+    if connection is not None:
+        connection.close()
+
+    # the same ranking as !squares, over the exported reacts
+    leaderboard = Leaderboard((color, target_id, source_id, num) for ((color, target_id, source_id), num) in pair_counts.items())
+    writer = writers["leaderboard"] = writer_type(args.out_dir, "leaderboard", args.chunk_rows)
+    ranking = ( entry for entry in leaderboard.ranking() if entry[0] not in squares.HIDDEN_USER_IDS )
+    for rank, (user_id, tally, score) in enumerate(ranking, start=1):
+        writer.write((rank, user_id, tally[Color.GREEN], tally[Color.YELLOW], tally[Color.RED], score))
+    writer.close()
+
+    manifest = {
+        "format" : args.format,
+        "since" : args.since,
+        "until" : until,
+        "tables" : { table : { "rows" : writer.num_rows, "files" : writer.filenames, "columns" : dict(TABLES[table]) } for (table, writer) in writers.items() },
+    }
+    with open(os.path.join(args.out_dir, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(", ".join(f"{writer.num_rows} {table}" for (table, writer) in writers.items()) + f" in {time.perf_counter() - start:.1f}s, until {until}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# Rescores every user in a react store under alternative weighting formulas
+# and shows how the !squares ordering would change. The store is read into
+# NumPy arrays, without touching the files the bot writes, and every formula
+# is computed for all users at once from the same per pair counts. Needs numpy
+# (pip install numpy), which the bot itself doesn't.
+#
+#   python tools/scoring.py data/guilds/<guild id> --formula sqrt-normalised --formula decayed --half-life 90
+#   python tools/scoring.py data/guilds/<guild id> --formula sqrt --weights red=-1,yellow=-1,green=3
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import features.squares as squares
+from features.squares import Color, COLOR_TO_WEIGHT, Leaderboard
+
+COLORS = list(Color)
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class ReactArrays:
+
+    # Every react in a store as parallel arrays, with user ids mapped to
+    # 0..len(user_ids) so they can index per user arrays directly. Timestamps
+    # are epoch seconds, NaN if unknown.
+
+    def __init__(self, user_ids, colors, targets, sources, timestamps):
+        self.user_ids = user_ids
+        self.colors = colors
+        self.targets = targets
+        self.sources = sources
+        self.timestamps = timestamps
+
+    @staticmethod
+    def from_columns(columns_by_color) -> "ReactArrays":
+        user_ids = np.unique(np.concatenate([ np.frombuffer(columns[0], dtype=np.uint64) for columns in columns_by_color.values() ] + [ np.empty(0, dtype=np.uint64) ]))
+        parts = []
+        for color, (color_user_ids, _, target_ids, source_ids, timestamps, _) in columns_by_color.items():
+            # the color interns its own users, so map those onto the shared ones
+            users = np.searchsorted(user_ids, np.frombuffer(color_user_ids, dtype=np.uint64))
+            targets = users[np.frombuffer(target_ids, dtype=np.uint32)]
+            parts.append((
+                np.full(len(targets), COLORS.index(color), dtype=np.uint8),
+                targets,
+                users[np.frombuffer(source_ids, dtype=np.uint32)],
+                np.frombuffer(timestamps, dtype=np.float64),
+            ))
+        return ReactArrays(user_ids, *(np.concatenate([ part[i] for part in parts ]) for i in range(4)))
+
+    @staticmethod
+    def load(data_dir) -> "ReactArrays":
+        if os.path.exists(os.path.join(data_dir, "squares.db")):
+            return ReactArrays._load_sqlite(os.path.join(data_dir, "squares.db"))
+        return ReactArrays._load_pickle(data_dir)
+
+    @staticmethod
+    def _load_pickle(data_dir) -> "ReactArrays":
+        # the same snapshot and journals the bot loads, replayed into a private copy
+        seq, reacts_by_color = squares._load_reacts_snapshot(os.path.join(data_dir, "reacts.data"))
+        seq = squares._replay_reacts_journal(os.path.join(data_dir, "reacts.log.old"), reacts_by_color, seq)
+        squares._replay_reacts_journal(os.path.join(data_dir, "reacts.log"), reacts_by_color, seq)
+        return ReactArrays.from_columns({ color : reacts_by_color[color].columns() for color in Color })
+
+    @staticmethod
+    def _load_sqlite(filename) -> "ReactArrays":
+        connection = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+        try:
+            rows = np.array(
+                connection.execute("SELECT color, target_id, source_id, IFNULL(timestamp, 'NaN') FROM reacts").fetchall(),
+                dtype=[ ("color", np.int64), ("target_id", np.uint64), ("source_id", np.uint64), ("timestamp", np.float64) ])
+        finally:
+            connection.close()
+        user_ids, users = np.unique(np.concatenate([ rows["target_id"], rows["source_id"] ]), return_inverse=True)
+        color_index = np.zeros(max(color.value for color in COLORS) + 1, dtype=np.uint8)
+        for i, color in enumerate(COLORS):
+            color_index[color.value] = i
+        colors = color_index[rows["color"]]
+        return ReactArrays(user_ids, colors, users[:len(rows)], users[len(rows):], rows["timestamp"])
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class Pairs:
+
+    # The reacts grouped by (color, target, source), which is all the formulas
+    # below need apart from the timestamps
+
+    def __init__(self, reacts: ReactArrays):
+        num_users = len(reacts.user_ids)
+        keys = (reacts.colors.astype(np.int64) * num_users + reacts.targets) * num_users + reacts.sources
+        keys, self.pair_of_react, self.counts = np.unique(keys, return_inverse=True, return_counts=True)
+        self.colors = keys // (num_users * num_users)
+        self.targets = keys // num_users % num_users
+        self.sources = keys % num_users
+        self.num_users = num_users
+
+    # Sums a value per pair into a (color, target) array
+    def per_color_and_target(self, values) -> np.ndarray:
+        return np.bincount(self.colors * self.num_users + self.targets, weights=values, minlength=len(COLORS) * self.num_users).reshape(len(COLORS), self.num_users)
+
+
+# Each formula scores every (color, target) from the pair counts. Like
+# weighted_squares, the score of each color is rounded down before the color
+# weights are applied.
+
+def sqrt_formula(reacts: ReactArrays, pairs: Pairs, args) -> np.ndarray:
+    return pairs.per_color_and_target(np.sqrt(pairs.counts))
+
+# The commented out alternative in weighted_squares: repeated squares count for
+# less the more squares their source hands out of that color
+def sqrt_normalised_formula(reacts: ReactArrays, pairs: Pairs, args) -> np.ndarray:
+    given = np.bincount(pairs.colors * pairs.num_users + pairs.sources, weights=pairs.counts, minlength=len(COLORS) * pairs.num_users)
+    return pairs.per_color_and_target(pairs.counts / np.sqrt(given[pairs.colors * pairs.num_users + pairs.sources]))
+
+# Each react counts for half as much every --half-life days before --now. Reacts
+# with no timestamp are taken to be as old as the oldest one with a timestamp.
+def decayed_formula(reacts: ReactArrays, pairs: Pairs, args) -> np.ndarray:
+    timestamps = reacts.timestamps
+    known = ~np.isnan(timestamps)
+    oldest = timestamps[known].min() if known.any() else args.now
+    ages = (args.now - np.where(known, timestamps, oldest)) / SECONDS_PER_DAY
+    weights = np.power(0.5, np.maximum(ages, 0.0) / args.half_life)
+    return pairs.per_color_and_target(np.sqrt(np.bincount(pairs.pair_of_react, weights=weights, minlength=len(pairs.counts))))
+
+FORMULAS = {
+    "sqrt" : sqrt_formula,
+    "sqrt-normalised" : sqrt_normalised_formula,
+    "decayed" : decayed_formula,
+}
+
+
+def parse_weights(text) -> dict:
+    weights = dict(COLOR_TO_WEIGHT)
+    for item in text.split(","):
+        (name, _, weight) = item.partition("=")
+        try:
+            weights[Color[name.strip().upper()]] = float(weight)
+        except (KeyError, ValueError):
+            raise argparse.ArgumentTypeError(f"bad weight({item}), expected e.g. red=-2,yellow=-1,green=2")
+    return weights
+
+def scores(per_color_and_target, weights) -> np.ndarray:
+    return sum(weights[color] * np.floor(per_color_and_target[i]) for i, color in enumerate(COLORS))
+
+# target index -> rank, ordered like Leaderboard: by decreasing score, then by user id
+def ranks(user_scores, user_ids, users) -> dict:
+    order = np.lexsort((user_ids[users], -user_scores[users]))
+    return { int(user) : rank for rank, user in enumerate(users[order], start=1) }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", help="a guild's data directory, e.g. data/guilds/<guild id>")
+    parser.add_argument("--formula", choices=FORMULAS.keys(), action="append", help="may be given more than once (default: every formula)")
+    parser.add_argument("--weights", type=parse_weights, default=dict(COLOR_TO_WEIGHT), help="per color weights, e.g. red=-2,yellow=-1,green=2")
+    parser.add_argument("--half-life", type=float, default=180.0, help="days, for decayed")
+    parser.add_argument("--now", type=float, default=time.time(), help="epoch seconds that decayed measures ages from")
+    parser.add_argument("--limit", type=int, default=25, help="users shown per formula, 0 for all")
+    parser.add_argument("--moved", action="store_true", help="only show users whose rank changes")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO) # replaying the journal logs every react
+    start = time.perf_counter()
+    reacts = ReactArrays.load(args.data_dir)
+    loaded = time.perf_counter()
+    pairs = Pairs(reacts)
+    print(f"{len(reacts)} reacts, {len(pairs.counts)} pairs, {len(reacts.user_ids)} users: loaded in {(loaded - start) * 1000:.0f}ms, grouped in {(time.perf_counter() - loaded) * 1000:.0f}ms")
+
+    # the live ordering, from the bot's own leaderboard so it can't drift from !squares
+    leaderboard = Leaderboard(
+        (COLORS[color], int(reacts.user_ids[target]), int(reacts.user_ids[source]), int(num))
+        for (color, target, source, num) in zip(pairs.colors, pairs.targets, pairs.sources, pairs.counts))
+    live = [ (user_id, score) for (user_id, _, score) in leaderboard.ranking() if user_id not in squares.HIDDEN_USER_IDS ]
+    live_rank = { user_id : rank for rank, (user_id, _) in enumerate(live, start=1) }
+    live_score = dict(live)
+    users = np.searchsorted(reacts.user_ids, np.array([ user_id for (user_id, _) in live ], dtype=np.uint64))
+
+    for name in args.formula or FORMULAS.keys():
+        start = time.perf_counter()
+        user_scores = scores(FORMULAS[name](reacts, pairs, args), args.weights)
+        rank = ranks(user_scores, reacts.user_ids, users)
+        elapsed = time.perf_counter() - start
+        rows = sorted(rank.items(), key=lambda item: item[1])
+        moved = sum(1 for (user, new_rank) in rows if live_rank[int(reacts.user_ids[user])] != new_rank)
+        print(f"\n{name}: {moved} of {len(rows)} users move, scored in {elapsed * 1000:.0f}ms")
+        print(f"{'rank':>5} {'live':>5} {'change':>6}  {'user id':<20} {'score':>10} {'live score':>10}")
+        if args.moved:
+            rows = [ (user, new_rank) for (user, new_rank) in rows if live_rank[int(reacts.user_ids[user])] != new_rank ]
+        for (user, new_rank) in rows[:args.limit or None]:
+            user_id = int(reacts.user_ids[user])
+            change = live_rank[user_id] - new_rank
+            print(f"{new_rank:>5} {live_rank[user_id]:>5} {change:>+6}  {user_id:<20} {user_scores[user]:>10.0f} {live_score[user_id]:>10}")
+
+
+if __name__ == "__main__":
+    main()